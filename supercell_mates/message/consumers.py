@@ -1,14 +1,56 @@
+import asyncio
 from json import loads, dumps, JSONDecodeError
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.urls import reverse
 from django.core.exceptions import ObjectDoesNotExist
 from datetime import datetime
 from channels.generic.websocket import AsyncWebsocketConsumer
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 
 from .models import PrivateChat, GroupChat, PrivateTextMessage, GroupTextMessage, PrivateFileMessage, GroupFileMessage, ReplyPostMessage
 from posts.models import Post
 from posts.views import has_access
+from utils.social_graph import SocialGraph
+from .write_behind import message_write_behind
+from .relay import chats_group_name, chat_relay_group_name
+from . import presence
+
+
+REPLY_POST_CACHE_SIZE = 16 # number of posts replied to that each connection remembers
+
+
+def text_message_data(event):
+    return {
+        "message": event["message"],
+        "user": event["user"],
+        "type": "text",
+        "id": event["id"],
+        "timestamp": event["timestamp"],
+    }
+
+
+def file_message_data(event):
+    return {
+        "file_name": event["file_name"],
+        "user": event["user"],
+        "type": "file",
+        "id": event["id"],
+        "timestamp": event["timestamp"],
+        "is_image": event["is_image"]
+    }
+
+
+def reply_post_data(event):
+    return {
+        "message": event["message"],
+        "user": event["user"],
+        "type": "reply_post",
+        "id": event["id"],
+        "timestamp": event["timestamp"],
+        "post": event["post"]
+    }
 
 
 class AbstractMessageConsumer(ABC, AsyncWebsocketConsumer):
@@ -21,9 +63,17 @@ class AbstractMessageConsumer(ABC, AsyncWebsocketConsumer):
         profile_img_url: URL to the profile image of the user
     chat_object: the instance of AbstractChat of this chat
     chat_name: the id of the current chat in the database
+    can_send: whether the current user may still send messages to this chat, checked at connect and
+        refreshed by access_changed events, so that sending a message makes no authorization query
+    reply_posts: the most recently replied posts, by post id, each None if the user has no access to it
+    presence_task: the task keeping the current user online while this connection is open, see message.presence,
+        None if this connection is not counted in the presence of the current user
     channel_layer, channel_name: inherit from AsyncWebsocketConsumer
     """
 
+    chat_type = None # "private" or "group", sent with the messages to ChatsConsumer connections
+
+
     @abstractmethod
     def verify_room(self):
         pass
@@ -45,21 +95,36 @@ class AbstractMessageConsumer(ABC, AsyncWebsocketConsumer):
     
 
     @abstractmethod
-    def add_text_message(self, message):
+    def new_text_message(self, message):
+        """Returns the unsaved text message of this chat sent by the current user."""
         pass
     
 
+    @database_sync_to_async
+    def add_text_message(self, message):
+        return self.parse_text_message(self.new_text_message(message))
+    
+
+    def queue_text_message(self, message):
+        """Queues the text message to be written by the write-behind queue, see message.write_behind.
+        The id and timestamp of the message are given before it is saved, so it can be broadcast immediately.
+        """
+        text_message = self.new_text_message(message)
+        message_write_behind().enqueue(text_message)
+        return (text_message.id, text_message.timestamp)
+    
+
     def parse_text_message(self, text_message):
         text_message.save()
         self.chat_object.timestamp = datetime.now().timestamp()
-        self.chat_object.save()
+        self.chat_object.save(update_fields=["timestamp"]) # last_message_timestamp was just moved forward by message.signals
         return (text_message.id, text_message.timestamp)
     
 
     def parse_reply_post_message(self, reply_post_message):
         reply_post_message.save()
         self.chat_object.timestamp = datetime.now().timestamp()
-        self.chat_object.save()
+        self.chat_object.save(update_fields=["timestamp"]) # last_message_timestamp was just moved forward by message.signals
         return (reply_post_message.id, reply_post_message.timestamp, {
             "id": reply_post_message.post.id,
             "title": reply_post_message.post.title,
@@ -73,6 +138,8 @@ class AbstractMessageConsumer(ABC, AsyncWebsocketConsumer):
     
 
     def parse_file_message(self, file_message):
+        if file_message is None:
+            return None
         return {
             "file_name": file_message.file_name,
             "timestamp": file_message.timestamp,
@@ -81,40 +148,77 @@ class AbstractMessageConsumer(ABC, AsyncWebsocketConsumer):
     
 
     @database_sync_to_async
-    def can_reply_post(self, post_id):
-        if Post.objects.filter(id=post_id).exists():
-            return has_access(self.user, Post.objects.get(id=post_id)) # check if the post belongs to the other user as well
-        return False
+    def load_reply_post(self, post_id):
+        post = Post.objects.select_related("creator").filter(id=post_id).first()
+        if post is not None and has_access(self.user, post, SocialGraph()): # check if the post belongs to the other user as well
+            return post
+        return None
+    
+
+    async def get_reply_post(self, post_id):
+        """Returns the post with the id if the current user can reply to it, otherwise None."""
+        if post_id in self.reply_posts:
+            self.reply_posts.move_to_end(post_id)
+        else:
+            self.reply_posts[post_id] = await self.load_reply_post(post_id)
+            if len(self.reply_posts) > REPLY_POST_CACHE_SIZE:
+                self.reply_posts.popitem(last=False)
+        return self.reply_posts[post_id]
     
 
     @abstractmethod
-    def add_reply_post(self, message, post_id):
+    def add_reply_post(self, message, post):
         pass
     
 
+    async def broadcast(self, event):
+        """Sends the event to the connections of this chat, and to the ChatsConsumer connections of the members,
+        with the id and type of this chat added so that those connections can tell which chat it belongs to.
+        Those connections are all in the relay group of this chat, so this makes two channel layer calls whatever the number of members.
+        """
+        chat_event = dict(event, chat_id=self.chat_name, chat_type=self.chat_type)
+        await asyncio.gather(
+            self.channel_layer.group_send(self.chat_name, event),
+            self.channel_layer.group_send(chat_relay_group_name(self.chat_name), chat_event),
+        )
+    
+
     async def connect(self):
         """Called when a user attempts to connect."""
 
         self.chat_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.user = self.scope["user"]
 
+        self.can_send = False
+        self.reply_posts = OrderedDict()
+        self.presence_task = None
         if await self.verify_room():
             self.user_info = await self.get_user_info(self.user)
             await self.channel_layer.group_add(self.chat_name, self.channel_name)
             await self.accept()
-            if not await self.can_connect():
+            self.can_send = await self.can_connect()
+            if not self.can_send:
                 await self.close(code=4003)
+            else:
+                self.presence_task = await presence.connected(self.user.id)
 
 
     async def disconnect(self, close_code):
         """Called when a user disconnects."""
         await self.channel_layer.group_discard(self.chat_name, self.channel_name)
+        if settings.MESSAGE_WRITE_BEHIND:
+            await message_write_behind().flush()
+        if self.presence_task is not None:
+            presence_task, self.presence_task = self.presence_task, None
+            await presence.disconnected(self.user.id, presence_task)
 
 
     async def receive(self, text_data):
         """Called when a user sends data to the channel.
         The corresponding channel layer then call the method with the same name as the value to the "type" field of the event.
         """
+        if not self.can_send:
+            return
         try:
             text_data_json = loads(text_data)
         except JSONDecodeError:
@@ -122,87 +226,106 @@ class AbstractMessageConsumer(ABC, AsyncWebsocketConsumer):
 
         if "type" in text_data_json.keys():
 
-            if text_data_json["type"] == "text":
+            if text_data_json["type"] == "heartbeat":
+                await presence.heartbeat(self.user.id)
+
+            elif text_data_json["type"] == "typing":
+                if await presence.start_typing(self.chat_name, self.user.id):
+                    await self.channel_layer.group_send(
+                        self.chat_name, {
+                            "type": "typing",
+                            "user": self.user_info,
+                        }
+                    )
+
+            elif text_data_json["type"] == "text":
                 if "message" in text_data_json.keys():
                     message = text_data_json["message"]
                     if len(message) <= 700: # text length limit
-                        text_id, timestamp = await self.add_text_message(message)
-                        await self.channel_layer.group_send(
-                            self.chat_name, {
-                                "type": "chat_message", 
-                                "message": message,
-                                "user": self.user_info,
-                                "id": text_id,
-                                "timestamp": timestamp,
-                            }
-                        )
+                        if settings.MESSAGE_WRITE_BEHIND:
+                            text_id, timestamp = self.queue_text_message(message)
+                        else:
+                            text_id, timestamp = await self.add_text_message(message)
+                        await self.broadcast({
+                            "type": "chat_message",
+                            "message": message,
+                            "user": self.user_info,
+                            "id": text_id,
+                            "timestamp": timestamp,
+                        })
             
             elif text_data_json["type"] == "file":
                 if "message_id" in text_data_json.keys():
                     message_id = text_data_json["message_id"]
                     message = await self.get_file_message(message_id)
+                    if message is None:
+                        return
                     message.update({
                         "id": message_id,
                         "type": "file_message",
                         "user": self.user_info
                     })
-                    await self.channel_layer.group_send(self.chat_name, message)
+                    await self.broadcast(message)
             
 
             elif text_data_json["type"] == "reply_post":
                 if isinstance(self, PrivateMessageConsumer) and "message" in text_data_json.keys() and "post_id" in text_data_json.keys():
                     message = text_data_json["message"]
-                    post_id = text_data_json["post_id"]
-                    if len(message) <= 700 and await self.can_reply_post(post_id):
-                        text_id, timestamp, post = await self.add_reply_post(message, post_id)
-                        await self.channel_layer.group_send(
-                            self.chat_name, {
-                                "type": "reply_post",
-                                "message": message,
-                                "post": post,
-                                "user": self.user_info,
-                                "id": text_id,
-                                "timestamp": timestamp
-                            }
-                        )
+                    post_id = str(text_data_json["post_id"])
+                    post = await self.get_reply_post(post_id) if len(message) <= 700 else None
+                    if post is not None:
+                        text_id, timestamp, post = await self.add_reply_post(message, post)
+                        await self.broadcast({
+                            "type": "reply_post",
+                            "message": message,
+                            "post": post,
+                            "user": self.user_info,
+                            "id": text_id,
+                            "timestamp": timestamp
+                        })
+
+
+    async def access_changed(self, event):
+        """Called when users are removed from this chat or two of its members stop being friends,
+        to check again whether the current user may stay connected.
+        """
+        if self.user.username not in event["usernames"]:
+            return
+        self.reply_posts.clear()
+        self.can_send = await self.verify_room() and await self.can_connect()
+        if not self.can_send:
+            await self.close(code=4003)
 
 
-    async def chat_message(self, event):
-        """Called in response to a user sending a message."""
+    async def typing(self, event):
+        """Called in response to a user typing, at most once every settings.TYPING_EVENT_INTERVAL seconds per user."""
+        if event["user"]["username"] == self.user.username:
+            return
         await self.send(text_data=dumps({
-            "message": event["message"],
             "user": event["user"],
-            "type": "text",
-            "id": event["id"],
-            "timestamp": event["timestamp"],
+            "type": "typing",
         }))
+
+
+    async def chat_message(self, event):
+        """Called in response to a user sending a message."""
+        await self.send(text_data=dumps(text_message_data(event)))
     
 
     async def file_message(self, event):
         """Called in response to a user sending a file."""
-        await self.send(text_data=dumps({
-            "file_name": event["file_name"],
-            "user": event["user"],
-            "type": "file",
-            "id": event["id"],
-            "timestamp": event["timestamp"],
-            "is_image": event["is_image"]
-        }))
+        await self.send(text_data=dumps(file_message_data(event)))
     
 
     async def reply_post(self, event):
         """Called in response to a user sending a post reply."""
-        await self.send(text_data=dumps({
-            "message": event["message"],
-            "user": event["user"],
-            "type": "reply_post",
-            "id": event["id"],
-            "timestamp": event["timestamp"],
-            "post": event["post"]
-        }))
+        await self.send(text_data=dumps(reply_post_data(event)))
 
 
 class PrivateMessageConsumer(AbstractMessageConsumer):
+    chat_type = "private"
+
+
     @database_sync_to_async
     def verify_room(self):
         if not self.user.is_authenticated:
@@ -218,29 +341,31 @@ class PrivateMessageConsumer(AbstractMessageConsumer):
 
     @database_sync_to_async
     def can_connect(self):
-        the_other_user = self.chat_object.users.exclude(username=self.user.username).first()
-        return the_other_user.user_log.friend_list.filter(user_auth=self.user).exists()
+        # read from the database on every check, as the friends may change while the connection is open
+        the_other_user = self.chat_object.users.exclude(username=self.user.username).select_related("user_log").first()
+        return the_other_user.user_log.id in SocialGraph(use_cache=False).friend_ids(self.user)
     
 
-    @database_sync_to_async
-    def add_text_message(self, message):
-        text_message = PrivateTextMessage(timestamp=datetime.now().timestamp(), user=self.user, chat=self.chat_object, text=message)
-        return self.parse_text_message(text_message)
+    def new_text_message(self, message):
+        return PrivateTextMessage(timestamp=datetime.now().timestamp(), user=self.user, chat=self.chat_object, text=message)
     
 
     @database_sync_to_async
     def get_file_message(self, message_id):
-        file_message = PrivateFileMessage.objects.get(id=message_id)
+        file_message = PrivateFileMessage.objects.filter(id=message_id, chat=self.chat_object).first()
         return self.parse_file_message(file_message)
     
 
     @database_sync_to_async
-    def add_reply_post(self, message, post_id):
-        reply_post_message = ReplyPostMessage(timestamp=datetime.now().timestamp(), user=self.user, chat=self.chat_object, text=message, post=Post.objects.get(id=post_id))
+    def add_reply_post(self, message, post):
+        reply_post_message = ReplyPostMessage(timestamp=datetime.now().timestamp(), user=self.user, chat=self.chat_object, text=message, post=post)
         return self.parse_reply_post_message(reply_post_message)
 
 
 class GroupMessageConsumer(AbstractMessageConsumer):
+    chat_type = "group"
+
+
     @database_sync_to_async
     def verify_room(self):
         if not self.user.is_authenticated:
@@ -259,17 +384,115 @@ class GroupMessageConsumer(AbstractMessageConsumer):
         return True
 
 
-    @database_sync_to_async
-    def add_text_message(self, message):
-        text_message = GroupTextMessage(timestamp=datetime.now().timestamp(), user=self.user, chat=self.chat_object, text=message)
-        return self.parse_text_message(text_message)
+    def new_text_message(self, message):
+        return GroupTextMessage(timestamp=datetime.now().timestamp(), user=self.user, chat=self.chat_object, text=message)
     
 
     @database_sync_to_async
     def get_file_message(self, message_id):
-        file_message = GroupFileMessage.objects.get(id=message_id)
+        file_message = GroupFileMessage.objects.filter(id=message_id, chat=self.chat_object).first()
         return self.parse_file_message(file_message)
     
 
-    def add_reply_post(self, message, post_id):
-        pass
\ No newline at end of file
+    def add_reply_post(self, message, post):
+        pass
+
+
+class ChatsConsumer(AsyncWebsocketConsumer):
+    """One connection per user receiving the messages of all the chats of the user, instead of one connection per chat.
+    The messages are sent in the same format as those of the chat consumers, with two more fields:
+        chat_id: the id of the chat of the message
+        chat_type: "private" or "group"
+    This connection only receives: messages are still sent through the connection of the sender to the chat (ws/message/ or ws/group/),
+    which relays them to the relay group of the chat, so a message reaches it only if some member sent it over such a connection.
+    Events that are not messages, such as typing and access_changed, are not relayed.
+    This connection is in the relay groups of the chats of the user, which it joins again on chats_changed events,
+    sent by the views that add users to chats or remove them, see message.relay.
+
+    Available instance fields:
+    user: the UserAuth instance of the current user
+    group_name: the name of the channel layer group of the ChatsConsumer connections of the current user
+    chat_ids: the set of ids of the chats whose relay groups this connection is in
+    presence_task: the task keeping the current user online while this connection is open, see message.presence
+    channel_layer, channel_name: inherit from AsyncWebsocketConsumer
+    """
+
+    async def connect(self):
+        """Called when a user attempts to connect."""
+        self.user = self.scope["user"]
+        self.presence_task = None
+        if not self.user.is_authenticated:
+            await self.close(code=4003)
+            return
+
+        self.group_name = chats_group_name(self.user.id)
+        self.chat_ids = set()
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.join_chats()
+        await self.accept()
+        self.presence_task = await presence.connected(self.user.id)
+
+
+    async def disconnect(self, close_code):
+        """Called when a user disconnects."""
+        if self.user.is_authenticated:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await asyncio.gather(*map(
+                lambda chat_id: self.channel_layer.group_discard(chat_relay_group_name(chat_id), self.channel_name), self.chat_ids
+            ))
+        if self.presence_task is not None:
+            presence_task, self.presence_task = self.presence_task, None
+            await presence.disconnected(self.user.id, presence_task)
+
+
+    async def receive(self, text_data):
+        """Called when a user sends data to the channel, only heartbeats are accepted."""
+        try:
+            text_data_json = loads(text_data)
+        except JSONDecodeError:
+            return
+        if "type" in text_data_json.keys() and text_data_json["type"] == "heartbeat":
+            await presence.heartbeat(self.user.id)
+
+
+    @database_sync_to_async
+    def get_chat_ids(self):
+        return set(self.user.private_chats.values_list("id", flat=True)) | set(self.user.group_chats.values_list("id", flat=True))
+
+
+    async def join_chats(self):
+        """Joins the relay groups of the chats the user is in, and leaves those of the chats the user is no longer in."""
+        chat_ids = await self.get_chat_ids()
+        await asyncio.gather(
+            *map(lambda chat_id: self.channel_layer.group_add(chat_relay_group_name(chat_id), self.channel_name), chat_ids - self.chat_ids),
+            *map(lambda chat_id: self.channel_layer.group_discard(chat_relay_group_name(chat_id), self.channel_name), self.chat_ids - chat_ids),
+        )
+        self.chat_ids = chat_ids
+
+
+    async def chats_changed(self, event):
+        """Called when the user is added to or removed from chats."""
+        await self.join_chats()
+
+
+    async def send_chat_data(self, event, data):
+        data.update({
+            "chat_id": event["chat_id"],
+            "chat_type": event["chat_type"],
+        })
+        await self.send(text_data=dumps(data))
+
+
+    async def chat_message(self, event):
+        """Called in response to a user sending a message to one of the chats of the current user."""
+        await self.send_chat_data(event, text_message_data(event))
+
+
+    async def file_message(self, event):
+        """Called in response to a user sending a file to one of the chats of the current user."""
+        await self.send_chat_data(event, file_message_data(event))
+
+
+    async def reply_post(self, event):
+        """Called in response to a user sending a post reply to one of the private chats of the current user."""
+        await self.send_chat_data(event, reply_post_data(event))
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.4 on 2026-10-17 02:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0004_auto_20230725_2210'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groupfilemessage',
+            index=models.Index(fields=['chat', 'timestamp'], name='group_file_chat_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='grouptextmessage',
+            index=models.Index(fields=['chat', 'timestamp'], name='group_text_chat_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatefilemessage',
+            index=models.Index(fields=['chat', 'timestamp'], name='private_file_chat_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatetextmessage',
+            index=models.Index(fields=['chat', 'timestamp'], name='private_text_chat_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='replypostmessage',
+            index=models.Index(fields=['chat', 'timestamp'], name='reply_post_chat_time_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.0.4 on 2026-10-17 02:31
+
+from django.db import migrations, models
+
+
+MESSAGE_KINDS = {
+    "private_text": "PrivateTextMessage",
+    "reply_post": "ReplyPostMessage",
+    "private_file": "PrivateFileMessage",
+    "group_text": "GroupTextMessage",
+    "group_file": "GroupFileMessage",
+}
+
+
+def index_existing_messages(apps, schema_editor):
+    MessageIndex = apps.get_model('message', 'MessageIndex')
+    for kind, model_name in MESSAGE_KINDS.items():
+        Message = apps.get_model('message', model_name)
+        MessageIndex.objects.bulk_create((
+            MessageIndex(chat_id=chat_id, timestamp=timestamp, kind=kind, message_id=message_id)
+            for (message_id, chat_id, timestamp) in Message.objects.values_list('id', 'chat_id', 'timestamp').iterator()
+        ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0005_groupfilemessage_group_file_chat_time_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.CharField(max_length=50)),
+                ('timestamp', models.FloatField()),
+                ('kind', models.CharField(max_length=15)),
+                ('message_id', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='messageindex',
+            index=models.Index(fields=['chat_id', 'timestamp', 'message_id'], name='message_index_chat_time_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='messageindex',
+            constraint=models.UniqueConstraint(fields=('kind', 'message_id'), name='message_index_kind_message_uniq'),
+        ),
+        migrations.RunPython(index_existing_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 4.0.4 on 2026-10-17 02:37
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+SEEN_MESSAGE_MODELS = ("PrivateTextMessage", "ReplyPostMessage", "PrivateFileMessage", "GroupTextMessage", "GroupFileMessage")
+
+
+def build_unread_state(apps, schema_editor):
+    MessageIndex = apps.get_model('message', 'MessageIndex')
+    ChatReadCursor = apps.get_model('message', 'ChatReadCursor')
+    for chat_model_name in ("PrivateChat", "GroupChat"):
+        Chat = apps.get_model('message', chat_model_name)
+        latest_timestamps = MessageIndex.objects.filter(chat_id=OuterRef('id')).order_by('-timestamp').values('timestamp')[:1]
+        Chat.objects.update(last_message_timestamp=Coalesce(Subquery(latest_timestamps), Value(0.0)))
+
+    last_seen_timestamps = {}
+    for model_name in SEEN_MESSAGE_MODELS:
+        Message = apps.get_model('message', model_name)
+        seen = Message.objects.filter(seen_users__isnull=False).values_list('chat_id', 'seen_users') \
+            .annotate(last_seen_timestamp=Max('timestamp')).order_by()
+        for chat_id, user_id, last_seen_timestamp in seen:
+            key = (chat_id, user_id)
+            last_seen_timestamps[key] = max(last_seen_timestamps.get(key, 0), last_seen_timestamp)
+    ChatReadCursor.objects.bulk_create((
+        ChatReadCursor(chat_id=chat_id, user_id=user_id, last_seen_timestamp=last_seen_timestamp)
+        for (chat_id, user_id), last_seen_timestamp in last_seen_timestamps.items()
+    ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('message', '0006_messageindex_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupchat',
+            name='last_message_timestamp',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='privatechat',
+            name='last_message_timestamp',
+            field=models.FloatField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ChatReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.CharField(max_length=50)),
+                ('last_seen_timestamp', models.FloatField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_read_cursors', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chatreadcursor',
+            constraint=models.UniqueConstraint(fields=('user', 'chat_id'), name='chat_read_cursor_user_chat_uniq'),
+        ),
+        migrations.RunPython(build_unread_state, migrations.RunPython.noop),
+    ]
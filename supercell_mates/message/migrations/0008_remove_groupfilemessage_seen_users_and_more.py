@@ -0,0 +1,35 @@
+# Generated by Django 4.0.4 on 2026-10-17 02:38
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0007_groupchat_last_message_timestamp_and_more'),
+    ]
+
+    # the read cursors were built from seen_users in 0007, and see_message has advanced them since,
+    # so they already hold everything the removed fields recorded
+    operations = [
+        migrations.RemoveField(
+            model_name='groupfilemessage',
+            name='seen_users',
+        ),
+        migrations.RemoveField(
+            model_name='grouptextmessage',
+            name='seen_users',
+        ),
+        migrations.RemoveField(
+            model_name='privatefilemessage',
+            name='seen_users',
+        ),
+        migrations.RemoveField(
+            model_name='privatetextmessage',
+            name='seen_users',
+        ),
+        migrations.RemoveField(
+            model_name='replypostmessage',
+            name='seen_users',
+        ),
+    ]
@@ -1,10 +1,13 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
 from posts.models import random_str
 
 """Chats"""
 class AbstractChat(models.Model):
     id = models.CharField(unique=True, primary_key=True, default=random_str, max_length=50)
     timestamp = models.FloatField()
+    last_message_timestamp = models.FloatField(default=0) # kept in sync with the messages by message.signals
 
     class Meta:
         abstract = True
@@ -29,6 +32,18 @@ class AbstractMessage(models.Model):
     class Meta:
         abstract = True
 
+    def delete(self, *args, **kwargs):
+        """Deletes the message together with its entry in the message index.
+        Messages deleted by cascade are removed from the message index in bulk by message.signals instead,
+        so that they can be deleted without being loaded.
+        """
+        chat_model = self._meta.get_field("chat").related_model
+        with transaction.atomic():
+            MessageIndex.objects.filter(kind=message_kind(self), message_id=self.id).delete()
+            result = super().delete(*args, **kwargs)
+            refresh_last_message_timestamps(chat_model, [self.chat_id])
+        return result
+
 # text message
 class TextMessage(AbstractMessage):
     text = models.TextField()
@@ -40,20 +55,32 @@ class TextMessage(AbstractMessage):
 class PrivateTextMessage(TextMessage):
     chat = models.ForeignKey(PrivateChat, on_delete=models.CASCADE, related_name='text_messages')
     user = models.ForeignKey('user_auth.UserAuth', on_delete=models.CASCADE, related_name='private_text_messages')
-    seen_users = models.ManyToManyField('user_auth.UserAuth', related_name='seen_private_text_messages')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "timestamp"], name="private_text_chat_time_idx"),
+        ]
 
 
 class ReplyPostMessage(TextMessage):
     chat = models.ForeignKey(PrivateChat, on_delete=models.CASCADE, related_name='reply_post_messages')
     post = models.ForeignKey('posts.Post', on_delete=models.SET_NULL, related_name='replies', null=True)
     user = models.ForeignKey('user_auth.UserAuth', on_delete=models.CASCADE, related_name='reply_post_messages')
-    seen_users = models.ManyToManyField('user_auth.UserAuth', related_name='seen_reply_post_messages')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "timestamp"], name="reply_post_chat_time_idx"),
+        ]
 
 
 class GroupTextMessage(TextMessage):
     chat = models.ForeignKey(GroupChat, on_delete=models.CASCADE, related_name='text_messages')
     user = models.ForeignKey('user_auth.UserAuth', on_delete=models.CASCADE, related_name='group_text_messages')
-    seen_users = models.ManyToManyField('user_auth.UserAuth', related_name='seen_group_text_messages')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "timestamp"], name="group_text_chat_time_idx"),
+        ]
 
 # file message
 class FileMessage(AbstractMessage):
@@ -68,10 +95,88 @@ class FileMessage(AbstractMessage):
 class PrivateFileMessage(FileMessage):
     chat = models.ForeignKey(PrivateChat, on_delete=models.CASCADE, related_name='file_messages')
     user = models.ForeignKey('user_auth.UserAuth', on_delete=models.CASCADE, related_name='private_file_messages')
-    seen_users = models.ManyToManyField('user_auth.UserAuth', related_name='seen_private_file_messages')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "timestamp"], name="private_file_chat_time_idx"),
+        ]
 
 
 class GroupFileMessage(FileMessage):
     chat = models.ForeignKey(GroupChat, on_delete=models.CASCADE, related_name='file_messages')
     user = models.ForeignKey('user_auth.UserAuth', on_delete=models.CASCADE, related_name='group_file_messages')
-    seen_users = models.ManyToManyField('user_auth.UserAuth', related_name='seen_group_file_messages')
\ No newline at end of file
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "timestamp"], name="group_file_chat_time_idx"),
+        ]
+
+"""Message Index"""
+class MessageIndex(models.Model):
+    """Timeline of the messages of every type in a chat, kept in sync with the message tables by message.signals.
+    A page of messages is read from this table with one indexed query, then fetched with one query per kind.
+    Entries of messages deleted with QuerySet.delete are left behind, and skipped when the messages are fetched.
+    """
+    chat_id = models.CharField(max_length=50)
+    timestamp = models.FloatField()
+    kind = models.CharField(max_length=15)
+    message_id = models.CharField(max_length=50)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["kind", "message_id"], name="message_index_kind_message_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["chat_id", "timestamp", "message_id"], name="message_index_chat_time_idx"),
+        ]
+
+
+# kinds of messages in the message index
+MESSAGE_KINDS = {
+    "private_text": PrivateTextMessage,
+    "reply_post": ReplyPostMessage,
+    "private_file": PrivateFileMessage,
+    "group_text": GroupTextMessage,
+    "group_file": GroupFileMessage,
+}
+PRIVATE_CHAT_MESSAGE_KINDS = ("private_text", "reply_post", "private_file")
+GROUP_CHAT_MESSAGE_KINDS = ("group_text", "group_file")
+
+
+def message_kind(message_obj):
+    """Returns the kind of the message in the message index."""
+    for kind, model in MESSAGE_KINDS.items():
+        if isinstance(message_obj, model):
+            return kind
+    return None
+
+
+def refresh_last_message_timestamps(chat_model, chat_ids):
+    """Recomputes the last_message_timestamp of the chats of the model from the message index, with one query."""
+    latest_timestamp = MessageIndex.objects.filter(chat_id=OuterRef("id")).values("chat_id") \
+        .annotate(latest=Max("timestamp")).values("latest")
+    chat_model.objects.filter(id__in=chat_ids).update(last_message_timestamp=Coalesce(Subquery(latest_timestamp), Value(0.0)))
+
+
+"""Read Cursors"""
+class ChatReadCursor(models.Model):
+    """The timestamp of the latest message a user has seen in a chat.
+    A chat has new messages for the user if its last_message_timestamp is after the last_seen_timestamp.
+    """
+    chat_id = models.CharField(max_length=50)
+    user = models.ForeignKey('user_auth.UserAuth', on_delete=models.CASCADE, related_name='chat_read_cursors')
+    last_seen_timestamp = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "chat_id"], name="chat_read_cursor_user_chat_uniq"),
+        ]
+
+
+def advance_read_cursor(chat_id, user_auth_obj, timestamp):
+    """Marks the messages in the chat up to the timestamp as seen by the user. The read cursor never moves backwards."""
+    cursor, created = ChatReadCursor.objects.get_or_create(
+        chat_id=chat_id, user=user_auth_obj, defaults={"last_seen_timestamp": timestamp}
+    )
+    if not created and cursor.last_seen_timestamp < timestamp:
+        ChatReadCursor.objects.filter(pk=cursor.pk, last_seen_timestamp__lt=timestamp).update(last_seen_timestamp=timestamp)
@@ -0,0 +1,107 @@
+"""Online presence and typing indicators, kept in the Redis server of the channel layer.
+
+A user is online while they have at least one chat connection open.
+Connections are counted per user, and the online users are kept in a sorted set scored by the time their presence expires.
+Each open connection sends a heartbeat of its user every third of settings.PRESENCE_TIMEOUT seconds from the server side,
+so a user whose connections were lost without disconnecting, e.g. because the process was killed,
+goes offline once no heartbeat has been received for settings.PRESENCE_TIMEOUT seconds.
+The connection counters have no expiry, as they are only read when a connection closes, and a counter left too high by a killed process
+only delays the user going offline until their presence expires.
+"""
+
+import time
+from weakref import WeakKeyDictionary
+import asyncio
+from django.conf import settings
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+
+ONLINE_USERS_KEY = "presence:online"
+
+
+def connections_key(user_id):
+    return f"presence:connections:{user_id}"
+
+
+def typing_key(chat_id, user_id):
+    return f"presence:typing:{chat_id}:{user_id}"
+
+
+_clients = WeakKeyDictionary()
+
+
+def presence_client():
+    """Returns the Redis client of the running event loop, connected to the Redis server of the channel layer."""
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        _clients[loop] = redis.from_url(settings.CHANNEL_LAYERS["default"]["CONFIG"]["hosts"][0])
+    return _clients[loop]
+
+
+async def heartbeat(user_id):
+    """Keeps the user online for another settings.PRESENCE_TIMEOUT seconds."""
+    await presence_client().zadd(ONLINE_USERS_KEY, {user_id: time.time() + settings.PRESENCE_TIMEOUT})
+
+
+async def keep_online(user_id):
+    """Sends a heartbeat of the user every third of settings.PRESENCE_TIMEOUT seconds, until the task is cancelled."""
+    while True:
+        await asyncio.sleep(settings.PRESENCE_TIMEOUT / 3)
+        try:
+            await heartbeat(user_id)
+        except (OSError, RedisError):
+            pass # the next heartbeat may succeed before the presence expires
+
+
+async def connected(user_id):
+    """Counts a new connection of the user, who is online from now on.
+
+    Returns:
+        Task: the task keeping the user online while the connection is open, to be passed to disconnected when it closes
+    """
+    async with presence_client().pipeline(transaction=False) as pipe:
+        pipe.incr(connections_key(user_id))
+        pipe.zadd(ONLINE_USERS_KEY, {user_id: time.time() + settings.PRESENCE_TIMEOUT})
+        await pipe.execute()
+    return asyncio.ensure_future(keep_online(user_id))
+
+
+async def disconnected(user_id, keep_online_task):
+    """Counts a closed connection of the user, who goes offline when no connection is left.
+
+    Args:
+        user_id (int): the id of the UserAuth instance of the user
+        keep_online_task (Task): the task returned by connected when the connection was opened
+    """
+    keep_online_task.cancel()
+    client = presence_client()
+    if await client.decr(connections_key(user_id)) <= 0:
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.delete(connections_key(user_id))
+            pipe.zrem(ONLINE_USERS_KEY, user_id)
+            # entries of users that expired without disconnecting are removed here, rather than on every heartbeat
+            pipe.zremrangebyscore(ONLINE_USERS_KEY, "-inf", time.time())
+            await pipe.execute()
+
+
+async def online_user_ids(user_ids):
+    """Returns the set of ids of the users that are online among the users with the ids, with one command.
+
+    Args:
+        user_ids (list(int)): the ids of the UserAuth instances of the users
+    """
+    if not user_ids:
+        return set()
+    expiry_times = await presence_client().zmscore(ONLINE_USERS_KEY, user_ids)
+    now = time.time()
+    return {user_id for user_id, expiry_time in zip(user_ids, expiry_times) if expiry_time is not None and expiry_time > now}
+
+
+async def start_typing(chat_id, user_id):
+    """Returns whether a typing event of the user in the chat should be broadcast.
+    Typing events of a user in a chat are coalesced to at most one every settings.TYPING_EVENT_INTERVAL seconds.
+    """
+    return bool(await presence_client().set(
+        typing_key(chat_id, user_id), 1, nx=True, px=int(settings.TYPING_EVENT_INTERVAL * 1000)
+    ))
@@ -0,0 +1,24 @@
+from utils.realtime import group_send_on_commit
+
+
+def chats_group_name(user_id):
+    """Returns the name of the channel layer group of the ChatsConsumer connections of the user."""
+    return f"chats_{user_id}"
+
+
+def chat_relay_group_name(chat_id):
+    """Returns the name of the channel layer group of the ChatsConsumer connections of the members of the chat,
+    to which the chat consumers relay the messages of the chat.
+    """
+    return f"chat_relay_{chat_id}"
+
+
+def push_chats_changed(user_ids):
+    """Makes the ChatsConsumer connections of the users join and leave the relay groups of their chats again,
+    once the transaction is committed, as the users were added to or removed from chats.
+
+    Args:
+        user_ids (list(int)): the ids of the UserAuth instances of the users
+    """
+    for user_id in user_ids:
+        group_send_on_commit(chats_group_name(user_id), {"type": "chats_changed"})
@@ -5,4 +5,5 @@ from . import consumers
 websocket_urlpatterns = [
     path("ws/message/<str:room_name>/", consumers.PrivateMessageConsumer.as_asgi()),
     path("ws/group/<str:room_name>/", consumers.GroupMessageConsumer.as_asgi()),
+    path("ws/chats/", consumers.ChatsConsumer.as_asgi()),
 ]
\ No newline at end of file
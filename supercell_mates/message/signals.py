@@ -0,0 +1,74 @@
+from django.db.models.signals import post_save, pre_delete
+
+from notification.push import push_new_messages
+from user_auth.models import UserAuth
+from .models import PrivateChat, GroupChat, MessageIndex, MESSAGE_KINDS, PRIVATE_CHAT_MESSAGE_KINDS, GROUP_CHAT_MESSAGE_KINDS, \
+    message_kind, refresh_last_message_timestamps
+
+
+def chat_model(kind):
+    """Returns the chat model of the messages of the kind."""
+    return GroupChat if kind in GROUP_CHAT_MESSAGE_KINDS else PrivateChat
+
+
+def index_messages(messages):
+    """Adds the messages to the message index, and moves the last_message_timestamp of their chats forward.
+
+    Args:
+        messages (list(AbstractMessage)): the newly created messages, of any kind
+    """
+    index_entries = [
+        MessageIndex(chat_id=message.chat_id, timestamp=message.timestamp, kind=message_kind(message), message_id=message.id)
+        for message in messages
+    ]
+    MessageIndex.objects.bulk_create(index_entries, ignore_conflicts=True)
+
+    latest_timestamps = {}
+    for entry in index_entries:
+        key = (chat_model(entry.kind), entry.chat_id)
+        latest_timestamps[key] = max(latest_timestamps.get(key, 0), entry.timestamp)
+    for (chat_model_class, chat_id), timestamp in latest_timestamps.items():
+        chat_model_class.objects.filter(id=chat_id, last_message_timestamp__lt=timestamp) \
+            .update(last_message_timestamp=timestamp)
+
+
+def message_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        index_messages([instance])
+        push_new_messages([instance])
+    else:
+        kind = message_kind(instance)
+        MessageIndex.objects.filter(kind=kind, message_id=instance.id) \
+            .update(chat_id=instance.chat_id, timestamp=instance.timestamp)
+        refresh_last_message_timestamps(chat_model(kind), [instance.chat_id])
+
+
+def chat_deleted(sender, instance, **kwargs):
+    """Removes the messages of the chat from the message index, with one query, before they are deleted by cascade."""
+    kinds = GROUP_CHAT_MESSAGE_KINDS if sender is GroupChat else PRIVATE_CHAT_MESSAGE_KINDS
+    MessageIndex.objects.filter(chat_id=instance.id, kind__in=kinds).delete()
+
+
+def user_deleted(sender, instance, **kwargs):
+    """Removes the messages of the user from the message index before they are deleted by cascade,
+    and recomputes the last_message_timestamp of their chats, with a few queries per kind of message.
+    """
+    for kind, message_model in MESSAGE_KINDS.items():
+        messages = message_model.objects.filter(user=instance)
+        chat_ids = list(messages.values_list("chat_id", flat=True).distinct())
+        if not chat_ids:
+            continue
+        MessageIndex.objects.filter(kind=kind, message_id__in=messages.values("id")).delete()
+        refresh_last_message_timestamps(chat_model(kind), chat_ids)
+
+
+# connected per message model, so that saving other models does not call them
+# deleted messages are handled by AbstractMessage.delete and the receivers of their chats and users, as delete receivers
+# on the message models would make Django load and delete every message one by one when a chat or user is deleted
+for message_model in MESSAGE_KINDS.values():
+    post_save.connect(message_saved, sender=message_model)
+pre_delete.connect(chat_deleted, sender=PrivateChat)
+pre_delete.connect(chat_deleted, sender=GroupChat)
+pre_delete.connect(user_deleted, sender=UserAuth)
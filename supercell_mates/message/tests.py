@@ -1,3 +1,267 @@
-from django.test import TestCase
+import json
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
-# Create your tests here.
+from user_auth.models import UserAuth
+from user_profile.models import UserProfile
+from user_log.models import UserLog
+from .models import PrivateChat, GroupChat, PrivateTextMessage, ReplyPostMessage, MessageIndex
+from .routing import websocket_urlpatterns
+
+
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def create_user(username):
+    user = UserAuth.objects.create_user(username=username, password="password")
+    user_profile_obj = UserProfile.objects.create(name=username, user_auth=user)
+    UserLog.objects.create(user_auth=user, user_profile=user_profile_obj)
+    return user
+
+
+async def keep_online(user_id):
+    return None
+
+
+# the chat consumers run their queries in other threads, which only see committed data
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, MESSAGE_WRITE_BEHIND=False)
+@mock.patch("message.presence.connected", keep_online)
+class UnreadChatsTest(TransactionTestCase):
+    """The chats with new messages must include the chats that received messages through the consumers and upload_file."""
+
+    def setUp(self):
+        self.sender = create_user("sender")
+        self.receiver = create_user("receiver")
+        self.sender.user_log.friend_list.add(self.receiver.user_log)
+        self.chat = PrivateChat.objects.create(timestamp=datetime.now().timestamp())
+        self.chat.users.add(self.sender, self.receiver)
+        self.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def chats_new_messages(self):
+        self.client.force_login(self.receiver)
+        return self.client.get("/notification/chats_new_messages", HTTP_HOST="localhost").json()["privates"]
+
+    async def send_over_websocket(self, data):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/message/{self.chat.id}/")
+        communicator.scope["user"] = self.sender
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_to(text_data=json.dumps(data))
+        response = json.loads(await communicator.receive_from())
+        await communicator.disconnect()
+        return response
+
+    def test_text_message_through_consumer(self):
+        self.assertEqual(self.chats_new_messages(), [])
+        response = async_to_sync(self.send_over_websocket)({"type": "text", "message": "hello"})
+        self.assertEqual(response["message"], "hello")
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_timestamp, response["timestamp"])
+        self.assertEqual(self.chats_new_messages(), [self.chat.id])
+
+    def test_file_message_through_upload_file(self):
+        self.client.force_login(self.sender)
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = self.client.post("/messages/upload_file", {
+                "chat_id": self.chat.id,
+                "file_name": "notes.txt",
+                "file": SimpleUploadedFile("notes.txt", b"notes"),
+            }, HTTP_HOST="localhost")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.chats_new_messages(), [self.chat.id])
+
+    def test_seen_message_is_not_new(self):
+        response = async_to_sync(self.send_over_websocket)({"type": "text", "message": "hello"})
+        self.client.force_login(self.receiver)
+        self.client.post("/notification/see_message", {
+            "message_id": response["id"],
+            "type": "text private",
+        }, HTTP_HOST="localhost")
+        self.assertEqual(self.chats_new_messages(), [])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, MESSAGE_WRITE_BEHIND=False)
+@mock.patch("message.presence.connected", keep_online)
+class ChatsConsumerTest(TransactionTestCase):
+    """ws/chats/ must receive the messages of the chats the user is in, including chats joined after connecting."""
+
+    def setUp(self):
+        self.creator = create_user("creator")
+        self.member = create_user("member")
+        self.creator.user_log.friend_list.add(self.member.user_log)
+
+    def post_as(self, user, url, data):
+        client = Client(HTTP_HOST="localhost")
+        client.force_login(user)
+        return client.post(url, data)
+
+    def communicator(self, path, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope["user"] = user
+        return communicator
+
+    async def send_to_group(self, sender, text):
+        await sender.send_to(text_data=json.dumps({"type": "text", "message": text}))
+        await sender.receive_from()
+
+    async def received_messages(self, communicator):
+        messages = []
+        while not await communicator.receive_nothing(0.2):
+            messages.append(json.loads(await communicator.receive_from())["message"])
+        return messages
+
+    async def run_chats(self):
+        chats = self.communicator("/ws/chats/", self.member)
+        await chats.connect()
+
+        # the chat is created after ws/chats/ connected
+        response = await database_sync_to_async(self.post_as)(self.creator, "/messages/create_group_chat", {
+            "group_name": "group",
+            "users": [self.member.username],
+        })
+        self.assertEqual(response.status_code, 200)
+        chat_id = response.json()["id"]
+        await chats.receive_nothing(0.2)
+        sender = self.communicator(f"/ws/group/{chat_id}/", self.creator)
+        await sender.connect()
+        channel_layer = get_channel_layer()
+        with mock.patch.object(channel_layer, "group_send", wraps=channel_layer.group_send) as group_send:
+            await self.send_to_group(sender, "one")
+        self.assertEqual(await self.received_messages(chats), ["one"])
+        # one call for the connections of the chat and one for the ws/chats/ connections, whatever the number of members
+        chat_groups = [group for (group, event), _ in group_send.call_args_list if not group.startswith("notifications_")]
+        self.assertEqual(len(chat_groups), 2)
+
+        response = await database_sync_to_async(self.post_as)(self.creator, "/messages/remove_user", {
+            "chatid": chat_id,
+            "username": self.member.username,
+        })
+        self.assertEqual(response.status_code, 200)
+        await chats.receive_nothing(0.2)
+        await self.send_to_group(sender, "two")
+        self.assertEqual(await self.received_messages(chats), [])
+
+        response = await database_sync_to_async(self.post_as)(self.creator, "/messages/add_member", {
+            "chat_id": chat_id,
+            "username": self.member.username,
+        })
+        self.assertEqual(response.status_code, 200)
+        await chats.receive_nothing(0.2)
+        await self.send_to_group(sender, "three")
+        self.assertEqual(await self.received_messages(chats), ["three"])
+
+        await sender.disconnect()
+        await chats.disconnect()
+
+    def test_chats_joined_and_left_after_connecting(self):
+        async_to_sync(self.run_chats)()
+
+
+class MessageDeletionTest(TestCase):
+    """Deleted messages must leave the message index, and deleting a chat or a user must not cost a query per message."""
+
+    def setUp(self):
+        self.sender = create_user("sender")
+        self.receiver = create_user("receiver")
+        self.chat = PrivateChat.objects.create(timestamp=0)
+        self.chat.users.add(self.sender, self.receiver)
+
+    def send(self, user, timestamp, count=1):
+        return [
+            PrivateTextMessage.objects.create(timestamp=timestamp + i, chat=self.chat, user=user, text="hello")
+            for i in range(count)
+        ]
+
+    def test_delete_message(self):
+        self.send(self.receiver, 1)
+        message = self.send(self.sender, 2)[0]
+        message.delete()
+        self.assertFalse(MessageIndex.objects.filter(message_id=message.id).exists())
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_timestamp, 1)
+
+    def test_delete_chat(self):
+        self.send(self.sender, 1, count=3)
+        with CaptureQueriesContext(connection) as few_messages:
+            PrivateChat.objects.get(id=self.chat.id).delete()
+        self.assertFalse(MessageIndex.objects.exists())
+
+        self.chat = PrivateChat.objects.create(timestamp=0)
+        self.send(self.sender, 1, count=30)
+        with CaptureQueriesContext(connection) as many_messages:
+            PrivateChat.objects.get(id=self.chat.id).delete()
+        self.assertFalse(MessageIndex.objects.exists())
+        self.assertEqual(len(many_messages.captured_queries), len(few_messages.captured_queries))
+
+    def test_delete_user(self):
+        other_sender = create_user("other_sender")
+        self.chat.users.add(other_sender)
+        self.send(other_sender, 1, count=3)
+        with CaptureQueriesContext(connection) as few_messages:
+            other_sender.delete()
+
+        self.send(self.receiver, 1)
+        self.send(self.sender, 2, count=30)
+        with CaptureQueriesContext(connection) as many_messages:
+            self.sender.delete()
+        self.assertEqual(len(many_messages.captured_queries), len(few_messages.captured_queries))
+        self.assertEqual(MessageIndex.objects.count(), 1)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_timestamp, 1)
+
+
+class MessagePagingTest(TestCase):
+    """Following next_cursor with the limit parameter must return every message of every kind once, in chronological order."""
+
+    def setUp(self):
+        self.sender = create_user("sender")
+        self.receiver = create_user("receiver")
+        self.chat = PrivateChat.objects.create(timestamp=0)
+        self.chat.users.add(self.sender, self.receiver)
+        self.client.force_login(self.receiver)
+
+    def get_page(self, params):
+        return self.client.get(f"/messages/get_private_messages/{self.chat.id}", params, HTTP_HOST="localhost")
+
+    def test_pages_cover_all_messages(self):
+        # messages with equal timestamps must not be skipped at the page boundaries
+        messages = [
+            PrivateTextMessage.objects.create(timestamp=i // 3, chat=self.chat, user=self.sender, text="hello")
+            for i in range(7)
+        ] + [
+            ReplyPostMessage.objects.create(timestamp=i // 3, chat=self.chat, user=self.receiver, text="reply", post=None)
+            for i in range(4)
+        ]
+        expected = [message.id for message in sorted(messages, key=lambda message: (message.timestamp, message.id))]
+
+        pages = []
+        params = {"limit": 2}
+        while True:
+            response = self.get_page(params)
+            self.assertEqual(response.status_code, 200, response.content)
+            content = response.json()
+            self.assertLessEqual(len(content["messages"]), 2)
+            pages.insert(0, [message["id"] for message in content["messages"]])
+            if content["next_cursor"] is None:
+                break
+            params = {"limit": 2, "before": content["next_cursor"]}
+        self.assertEqual([message_id for page in pages for message_id in page], expected)
+
+    def test_invalid_parameters(self):
+        for params in ({"limit": 0}, {"limit": 201}, {"limit": "two"}, {"limit": 2, "before": "yesterday"}):
+            with self.subTest(params=params):
+                self.assertEqual(self.get_page(params).status_code, 400)
@@ -1,22 +1,31 @@
 from django.shortcuts import render, redirect
 from django.urls import reverse
-from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, FileResponse, HttpResponseNotFound
+from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, HttpResponseNotFound
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate
 from django.utils.datastructures import MultiValueDictKeyError
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import ensure_csrf_cookie
 from datetime import datetime
 from django.core.files.base import ContentFile
 from PIL import Image
 from user_profile.views import verify_image
+from utils.upload import is_binary_upload, upload_params, read_binary_upload, reject_oversized_uploads
+from utils.media import image_file_response, versioned_media_url, deliver_media
+from utils.realtime import group_send_on_commit
+from .relay import push_chats_changed
 import json
 
 from user_auth.models import UserAuth
-from .models import TextMessage, PrivateChat, FileMessage, PrivateFileMessage, GroupChat, GroupFileMessage, ReplyPostMessage
+from posts.models import Post
+from .models import TextMessage, PrivateChat, FileMessage, PrivateFileMessage, GroupChat, GroupFileMessage, ReplyPostMessage, \
+    MessageIndex, MESSAGE_KINDS, PRIVATE_CHAT_MESSAGE_KINDS, GROUP_CHAT_MESSAGE_KINDS, advance_read_cursor
 
 
+MESSAGES_PAGE_MAX_LIMIT = 200 # maximum number of messages returned in one keyset paginated request
+
 @login_required
 def index(request):
     """Returns the template for viewing chats in web frontend
@@ -59,7 +68,7 @@ def create_group_chat(request):
         groupchat.admins.add(request.user)
         for user in users:
             groupchat.users.add(UserAuth.objects.get(username=user))
-        groupchat.save()
+        push_chats_changed(list(groupchat.users.values_list("id", flat=True)))
         return JsonResponse({
             "id": groupchat.id,
             "timestamp": groupchat.timestamp,
@@ -153,6 +162,7 @@ def add_member(request):
             return HttpResponseBadRequest("you are not friend with this user")
         
         chat.users.add(new_user)
+        push_chats_changed([new_user.id])
         return HttpResponse('ok')
     
     except MultiValueDictKeyError:
@@ -185,6 +195,8 @@ def remove_user(request):
             return HttpResponseBadRequest("you cannot remove another admin")
         chat.users.remove(user)
         chat.admins.remove(user) # in case the person doing this request is the creator
+        group_send_on_commit(chat.id, {"type": "access_changed", "usernames": [username]})
+        push_chats_changed([user.id])
         return HttpResponse("ok")
     
     except MultiValueDictKeyError:
@@ -280,7 +292,7 @@ def assign_leader(request):
             return HttpResponseBadRequest("user with provided username not admin of this chat")
         
         chat.creator = user 
-        chat.save()
+        chat.save(update_fields=["creator"])
         return HttpResponse("ok")
 
     except MultiValueDictKeyError:
@@ -312,6 +324,7 @@ def chat_info(chat_object):
 def get_group_chat_rep_img(request, chat_id):
     """Return the representative image of a group chat.
     This view checks whether the user is in the group chat first before allowing the user to access the photo.
+    The optional GET parameter size selects a scaled down derivative of the image (see utils.media).
 
     Args:
         request (HttpRequest): request made to this view
@@ -325,7 +338,7 @@ def get_group_chat_rep_img(request, chat_id):
         if request.user in groupchat.users.all():
             rep_img = groupchat.rep_img
             if rep_img:
-                return FileResponse(rep_img)
+                return image_file_response(request, rep_img)
             else:
                 return redirect('/static/media/default_profile_pic.jpg')
         else:
@@ -458,8 +471,15 @@ def get_private_chats(request):
 
 
 def message_info(message_obj):
-    """Get the info of a message in a dictionary.
-    The returned dictionary contains the following fields:
+    """Get the info of a message in a dictionary, which is the result of message_infos on this message alone."""
+    return message_infos([message_obj])[0]
+
+
+def message_infos(messages):
+    """Get the info of each message in a list of messages of any kinds, in the same order.
+    Senders (with their profiles) and replied posts are fetched with one query each, and the URLs of each sender
+    are only computed once.
+    Each returned dictionary contains the following fields:
         id: the id of the message
         timestamp: the timestamp of the message in epoch time
         user: the sender of the message, in the form of a dict, with the following fields:
@@ -467,61 +487,58 @@ def message_info(message_obj):
             username: the username of the user
             profile_link: the link to the profile of the user
             profile_img_url: the URL to the profile image of the user
+        type: the type of the message, which is one of "text", "file", "reply_post"
+    Text messages additionally have the field message, file messages have the fields file_name and is_image,
+    and reply post messages have the fields message and post (id, title and content of the post, or None).
+
+    Args:
+        messages (list): the list of messages to get the info of
+    
+    Returns:
+        list: the list of dictionaries containing the info of the messages
     """
-    result = {
-        "id": message_obj.id,
-        "timestamp": message_obj.timestamp,
-        "user": {
-            "name": message_obj.user.user_profile.name,
-            "username": message_obj.user.username,
-            "profile_link": reverse("user_log:view_profile", args=(message_obj.user.username,)),
-            "profile_img_url": reverse("user_profile:get_profile_pic", args=(message_obj.user.username,)),
-        },
-        "type": "reply_post" if isinstance(message_obj, ReplyPostMessage) else "text" if isinstance(message_obj, TextMessage) else "file" if isinstance(message_obj, FileMessage) else "unknown"
+    senders = UserAuth.objects.select_related("user_profile").in_bulk(set(map(lambda message: message.user_id, messages)))
+    sender_infos = {
+        user_id: {
+            "name": user_auth_obj.user_profile.name,
+            "username": user_auth_obj.username,
+            "profile_link": reverse("user_log:view_profile", args=(user_auth_obj.username,)),
+            "profile_img_url": versioned_media_url(
+                reverse("user_profile:get_profile_pic", args=(user_auth_obj.username,)), user_auth_obj.user_profile.profile_pic.name
+            ),
+        } for user_id, user_auth_obj in senders.items()
     }
-    if result["type"] == "text":
-        result["message"] = message_obj.text
-    elif result["type"] == "file":
-        result.update({
-            "file_name": message_obj.file_name,
-            "is_image": message_obj.is_image
-        })
-    elif result["type"] == "reply_post":
-        result.update({
-            "message": message_obj.text,
-            "post": {
-                "id": message_obj.post.id,
-                "title": message_obj.post.title,
-                "content": message_obj.post.content
-            } if message_obj.post else None
-        })
-    return result
-
-
-def merge_messages(all_text_messages, all_reply_post_messages, all_file_messages):
-    def next_message_timestamp(message_list, i):
-        return message_list[i].timestamp if i < len(message_list) else 1e10
-
-    all_messages = []
-    text_i = 0
-    post_i = 0
-    file_i = 0
-    while text_i < len(all_text_messages) or post_i < len(all_reply_post_messages) or file_i < len(all_file_messages):
-        next_timestamp = min(
-            next_message_timestamp(all_text_messages, text_i), 
-            next_message_timestamp(all_reply_post_messages, post_i), 
-            next_message_timestamp(all_file_messages, file_i)
-        )
-        if next_message_timestamp(all_text_messages, text_i) == next_timestamp:
-            all_messages.append(all_text_messages[text_i])
-            text_i += 1
-        elif next_message_timestamp(all_file_messages, file_i) == next_timestamp:
-            all_messages.append(all_file_messages[file_i])
-            file_i += 1
-        else:
-            all_messages.append(all_reply_post_messages[post_i])
-            post_i += 1
-    return all_messages
+    posts = Post.objects.only("id", "title", "content").in_bulk(set(
+        message.post_id for message in messages if isinstance(message, ReplyPostMessage) and message.post_id is not None
+    ))
+
+    results = []
+    for message_obj in messages:
+        result = {
+            "id": message_obj.id,
+            "timestamp": message_obj.timestamp,
+            "user": sender_infos[message_obj.user_id],
+            "type": "reply_post" if isinstance(message_obj, ReplyPostMessage) else "text" if isinstance(message_obj, TextMessage) else "file" if isinstance(message_obj, FileMessage) else "unknown"
+        }
+        if result["type"] == "text":
+            result["message"] = message_obj.text
+        elif result["type"] == "file":
+            result.update({
+                "file_name": message_obj.file_name,
+                "is_image": message_obj.is_image
+            })
+        elif result["type"] == "reply_post":
+            post = posts.get(message_obj.post_id)
+            result.update({
+                "message": message_obj.text,
+                "post": {
+                    "id": post.id,
+                    "title": post.title,
+                    "content": post.content
+                } if post else None
+            })
+        results.append(result)
+    return results
 
 
 def start_and_end(request):
@@ -545,34 +562,149 @@ def start_and_end(request):
         return "time provided is too large, not epoch time"
 
 
+def before_and_limit(request):
+    """Return the before cursor and limit values in the parameter, if there is an error, return a string.
+    The before cursor has the form "<timestamp>,<message id>" and is None if the parameter is not provided.
+
+    Args:
+        request (HttpRequest): the request to extract GET parameters from
+    
+    Returns:
+        tuple/str: before cursor (as a (timestamp, message id) tuple or None) and limit from the request GET parameters,
+            or a string if there is an error
+    """
+    try:
+        limit = int(request.GET["limit"])
+    except MultiValueDictKeyError:
+        return "limit GET parameter not provided"
+    except ValueError:
+        return "limit GET parameter provided not an integer"
+    if limit <= 0 or limit > MESSAGES_PAGE_MAX_LIMIT:
+        return f"limit must be between 1 and {MESSAGES_PAGE_MAX_LIMIT}"
+
+    if "before" not in request.GET:
+        return (None, limit)
+    try:
+        timestamp, message_id = request.GET["before"].split(",", 1)
+        return ((float(timestamp), message_id), limit)
+    except ValueError:
+        return "before GET parameter must be of the form <timestamp>,<message id>"
+
+
+def chat_message_kinds(chat_obj):
+    """Returns the kinds of messages, as in the message index, that the chat can contain."""
+    return PRIVATE_CHAT_MESSAGE_KINDS if isinstance(chat_obj, PrivateChat) else GROUP_CHAT_MESSAGE_KINDS
+
+
+def fetch_indexed_messages(index_entries):
+    """Returns the messages referenced by the message index entries, in the same order.
+    Messages are fetched with one query per kind.
+
+    Args:
+        index_entries (list(MessageIndex)): the entries of the message index
+    
+    Returns:
+        list(AbstractMessage): the messages
+    """
+    message_ids = {}
+    for entry in index_entries:
+        message_ids.setdefault(entry.kind, []).append(entry.message_id)
+    messages = {
+        kind: MESSAGE_KINDS[kind].objects.in_bulk(ids)
+        for kind, ids in message_ids.items()
+    }
+    return [
+        messages[entry.kind][entry.message_id]
+        for entry in index_entries
+        if entry.message_id in messages[entry.kind]
+    ]
+
+
 def get_texts(chat_obj, start, end):
-    all_text_messages = list(chat_obj.text_messages.filter(timestamp__range=(start, end)).all())
-    all_reply_post_messages = list(chat_obj.reply_post_messages.filter(timestamp__range=(start, end)).all()) if isinstance(chat_obj, PrivateChat) else []
-    all_file_messages = list(chat_obj.file_messages.filter(timestamp__range=(start, end)).all())
-    all_messages = merge_messages(all_text_messages, all_reply_post_messages, all_file_messages)
-    
-    next_text_messages = chat_obj.text_messages.filter(timestamp__lt=start).order_by("timestamp")
-    next_file_messages = chat_obj.file_messages.filter(timestamp__lt=start).order_by("timestamp")
-    next_reply_post_messages = chat_obj.reply_post_messages.filter(timestamp__lt=start).order_by("timestamp") if isinstance(chat_obj, PrivateChat) else None
-    next_last_timestamp = max(
-        next_text_messages.last().timestamp if next_text_messages.exists() else 0,
-        0 if next_reply_post_messages is None else next_reply_post_messages.last().timestamp if next_reply_post_messages.exists() else 0,
-        next_file_messages.last().timestamp if next_file_messages.exists() else 0
-    )
+    """Returns the messages of all kinds in the chat within the time frame, together with the timestamp
+    of the latest message before the time frame (0 if there is none).
+    """
+    chat_index = MessageIndex.objects.filter(chat_id=chat_obj.id, kind__in=chat_message_kinds(chat_obj))
+    all_messages = fetch_indexed_messages(list(
+        chat_index.filter(timestamp__range=(start, end)).order_by("timestamp", "message_id")
+    ))
+    next_last_timestamp = chat_index.filter(timestamp__lt=start).order_by("-timestamp") \
+        .values_list("timestamp", flat=True).first() or 0
     
     return all_messages, next_last_timestamp
 
 
+def get_texts_before(chat_obj, before, limit):
+    """Returns at most limit messages of all kinds in the chat that come strictly before the cursor (the latest
+    messages if the cursor is None), in chronological order, together with the cursor of the next (older) page,
+    which is None if there are no older messages.
+    Messages are ordered by (timestamp, message id), so that messages with equal timestamps are never skipped.
+    """
+    chat_index = MessageIndex.objects.filter(chat_id=chat_obj.id, kind__in=chat_message_kinds(chat_obj))
+    if before is not None:
+        timestamp, message_id = before
+        chat_index = chat_index.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, message_id__lt=message_id))
+    index_entries = list(chat_index.order_by("-timestamp", "-message_id")[:limit + 1])
+
+    next_cursor = None
+    if len(index_entries) > limit:
+        index_entries = index_entries[:limit]
+        next_cursor = f"{index_entries[-1].timestamp!r},{index_entries[-1].message_id}"
+    index_entries.reverse()
+
+    return fetch_indexed_messages(index_entries), next_cursor
+
+
+def chat_messages_response(request, chat_obj):
+    """Returns the response of get_group_messages and get_private_messages for a chat the request user is in.
+    If the limit GET parameter is provided, the messages are paginated by the before cursor, otherwise by
+    the start and end time frame.
+
+    Args:
+        request (HttpRequest): the request made to the view
+        chat_obj (AbstractChat): the chat to get messages from
+    
+    Returns:
+        HttpResponse: the json containing the info of the messages, or the error in the GET parameters
+    """
+    if "limit" in request.GET:
+        get_params = before_and_limit(request)
+        if type(get_params) == str:
+            return HttpResponseBadRequest(get_params)
+        before, limit = get_params
+        all_messages, next_cursor = get_texts_before(chat_obj, before, limit)
+        pagination = {"next_cursor": next_cursor}
+    else:
+        get_params = start_and_end(request)
+        if type(get_params) == str:
+            return HttpResponseBadRequest(get_params)
+        start, end = get_params
+        all_messages, next_last_timestamp = get_texts(chat_obj, start, end)
+        pagination = {"next_last_timestamp": next_last_timestamp}
+    
+    if request.method == "POST" and len(all_messages) > 0:
+        advance_read_cursor(chat_obj.id, request.user, all_messages[len(all_messages) - 1].timestamp)
+
+    return JsonResponse({
+        "messages": message_infos(all_messages),
+        **pagination
+    })
+
+
 @login_required
 def get_group_messages(request, chat_id):
-    """Get messages in a given chat id within the given time frame.
+    """Get messages in a given chat id within the given time frame, or a page of at most limit messages before a cursor.
     This view checks for whether the person is in the chat before releasing the messages.
     GET parameters:
         start: the start time in epoch time
         end: the end time in epoch time
+    or, for keyset pagination:
+        limit: the maximum number of messages to return (at most MESSAGES_PAGE_MAX_LIMIT)
+        before (optional): the next_cursor of the previous page; if not provided, the latest messages are returned
     The returned response contains the following fields:
-        messages: a list of dicts representing the info of the messages, each is the result of the message_info function above
-        next_last_timestamp: the end timestamp that the next request should have
+        messages: a list of dicts representing the info of the messages, computed by the message_infos function above
+        next_last_timestamp: the end timestamp that the next request should have (time frame mode only)
+        next_cursor: the before cursor that the next request should have, null if there are no older messages (keyset mode only)
     
     Args:
         request (HttpRequest): the request made to this view
@@ -589,34 +721,23 @@ def get_group_messages(request, chat_id):
     if not chat_obj.users.filter(username=request.user.username).exists():
         return HttpResponseBadRequest("you do not have access to this chat")
     
-    get_params = start_and_end(request)
-    if type(get_params) == str:
-        return HttpResponseBadRequest(get_params)
-    start, end = get_params
-    
-    all_messages, next_last_timestamp = get_texts(chat_obj, start, end)
-    if request.method == "POST" and len(all_messages) > 0:
-        all_messages[len(all_messages) - 1].seen_users.add(request.user)
-
-    return JsonResponse({
-        "messages": list(map(
-            lambda message: message_info(message),
-            all_messages
-        )),
-        "next_last_timestamp": next_last_timestamp
-    })
+    return chat_messages_response(request, chat_obj)
 
 
 @login_required
 def get_private_messages(request, chat_id):
-    """Get messages in a given chat id within the given time frame.
+    """Get messages in a given chat id within the given time frame, or a page of at most limit messages before a cursor.
     This view checks for whether the person is in the chat before releasing the messages.
     GET parameters:
         start: the start time in epoch time
         end: the end time in epoch time
+    or, for keyset pagination:
+        limit: the maximum number of messages to return (at most MESSAGES_PAGE_MAX_LIMIT)
+        before (optional): the next_cursor of the previous page; if not provided, the latest messages are returned
     The returned response contains the following fields:
-        messages: a list of dicts representing info of the messages, each is the result of the message_info function above
-        next_last_timestamp: the end timestamp that the next incoming request should have
+        messages: a list of dicts representing info of the messages, computed by the message_infos function above
+        next_last_timestamp: the end timestamp that the next incoming request should have (time frame mode only)
+        next_cursor: the before cursor that the next request should have, null if there are no older messages (keyset mode only)
 
     Args:
         request (HttpRequest): the request made to this view
@@ -633,26 +754,12 @@ def get_private_messages(request, chat_id):
     if not chat_obj.users.filter(username=request.user.username).exists():
         return HttpResponseBadRequest("you do not have access to this chat")
     
-    get_params = start_and_end(request)
-    if type(get_params) == str:
-        return HttpResponseBadRequest(get_params)
-    start, end = get_params
-    
-    all_messages, next_last_timestamp = get_texts(chat_obj, start, end)
-    if request.method == "POST" and len(all_messages) > 0:
-        all_messages[len(all_messages) - 1].seen_users.add(request.user)
-
-    return JsonResponse({
-        "messages": list(map(
-            lambda message: message_info(message),
-            all_messages
-        )),
-        "next_last_timestamp": next_last_timestamp
-    })
+    return chat_messages_response(request, chat_obj)
 
 
 @login_required
 @require_http_methods(["POST"])
+@reject_oversized_uploads
 def upload_file(request):
     """Upload a file through a message.
     The view checks for access privileges before processing file uploading
@@ -660,9 +767,12 @@ def upload_file(request):
         file: the file to be uploaded
         file_name: the name of the file
         chat_id: the id of the chat to upload
+    Alternatively, the request body can be the file itself, with content type application/octet-stream,
+    in which case file_name and chat_id are in the query string.
     """
     try:
-        chat_id = request.POST["chat_id"]
+        params = upload_params(request)
+        chat_id = params["chat_id"]
         if PrivateChat.objects.filter(id=chat_id).exists():
             chat_obj = PrivateChat.objects.get(id=chat_id)
         elif GroupChat.objects.filter(id=chat_id).exists():
@@ -675,8 +785,13 @@ def upload_file(request):
 
         is_image = True
 
-        if "file" in request.POST:
-            file_bytearray = bytearray(json.loads(request.POST["file"]))
+        if is_binary_upload(request):
+            file_uploaded = read_binary_upload(request, params["file_name"])
+            if file_uploaded is None:
+                return HttpResponseBadRequest("file too large")
+            is_image = verify_image(file_uploaded)
+        elif "file" in request.POST:
+            file_bytearray = bytes(json.loads(request.POST["file"]))
             file_uploaded = ContentFile(file_bytearray, name=request.POST["file_name"])
             try:
                 pil_img = Image.open(file_uploaded)
@@ -686,14 +801,14 @@ def upload_file(request):
         else:
             file_uploaded = request.FILES["file"]
             is_image = verify_image(file_uploaded)
-        file_name = request.POST["file_name"]
+        file_name = params["file_name"]
         if isinstance(chat_obj, PrivateChat):
             file_message = PrivateFileMessage(timestamp=datetime.now().timestamp(), file_field=file_uploaded, file_name=file_name, chat=chat_obj, user=request.user, is_image=is_image)
         else:
             file_message = GroupFileMessage(timestamp=datetime.now().timestamp(), file_field=file_uploaded, file_name=file_name, chat=chat_obj, user=request.user, is_image=is_image)
         file_message.save()
         chat_obj.timestamp = datetime.now().timestamp()
-        chat_obj.save()
+        chat_obj.save(update_fields=["timestamp"]) # last_message_timestamp was just moved forward by message.signals
         return HttpResponse(file_message.id)
     
     except MultiValueDictKeyError:
@@ -706,6 +821,7 @@ def get_image(request, message_id):
     The user must be in the chat in order to see the file.
     If the id does not match any message, return 404.
     Checking whether the returned file is an image must be done in elsewhere.
+    For images, the optional GET parameter size selects a scaled down derivative of the image (see utils.media).
     """
     try:
         if PrivateFileMessage.objects.filter(id=message_id).exists():
@@ -716,7 +832,9 @@ def get_image(request, message_id):
             return HttpResponseBadRequest("you do not have access to this chat message")
 
         file_field = message.file_field
-        return FileResponse(file_field)
+        if message.is_image:
+            return image_file_response(request, file_field)
+        return deliver_media(file_field.storage, file_field.name)
     
     except ObjectDoesNotExist:
         return HttpResponseNotFound("message not found")
@@ -771,6 +889,8 @@ def remove_self(request):
         
         chat.users.remove(request.user)
         chat.admins.remove(request.user)
+        group_send_on_commit(chat.id, {"type": "access_changed", "usernames": [request.user.username]})
+        push_chats_changed([request.user.id])
         return HttpResponse("ok")
     
     except MultiValueDictKeyError:
@@ -0,0 +1,99 @@
+import asyncio
+from weakref import WeakKeyDictionary
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from notification.push import push_new_messages
+from .signals import chat_model, index_messages
+from .models import message_kind
+
+
+def write_messages(messages):
+    """Saves the new messages with one bulk insert per kind of message.
+    As bulk_create does not send post_save, the messages are indexed here, and the timestamp of each chat is updated once.
+
+    Args:
+        messages (list(AbstractMessage)): the unsaved messages, of any kind, with their ids and timestamps already set
+    """
+    messages_of_model = {}
+    for message in messages:
+        messages_of_model.setdefault(type(message), []).append(message)
+
+    with transaction.atomic():
+        for model, model_messages in messages_of_model.items():
+            model.objects.bulk_create(model_messages)
+        index_messages(messages)
+        update_chat_timestamps(messages)
+        push_new_messages(messages)
+
+
+def update_chat_timestamps(messages):
+    """Moves the timestamp of the chat of each message forward to the timestamp of its latest message."""
+    latest_timestamps = {}
+    for message in messages:
+        key = (chat_model(message_kind(message)), message.chat_id)
+        latest_timestamps[key] = max(latest_timestamps.get(key, 0), message.timestamp)
+    for (chat_model_class, chat_id), timestamp in latest_timestamps.items():
+        chat_model_class.objects.filter(id=chat_id, timestamp__lt=timestamp).update(timestamp=timestamp)
+
+
+def write_messages_one_by_one(messages):
+    """Saves the messages one at a time, dropping those that cannot be saved, e.g. because their chat has been deleted."""
+    for message in messages:
+        try:
+            with transaction.atomic():
+                message.save(force_insert=True)
+                update_chat_timestamps([message])
+        except DatabaseError:
+            pass
+
+
+class MessageWriteBehind:
+    """Queue of the messages sent over WebSocket in this process, written to the database in batches.
+    Consumers broadcast a message as soon as it is queued, with the id and timestamp already given to it.
+    The queue is flushed settings.MESSAGE_WRITE_BEHIND_FLUSH_INTERVAL seconds after its first message is queued,
+    or as soon as it holds settings.MESSAGE_WRITE_BEHIND_BATCH_SIZE messages, whichever comes first.
+    Messages that are still queued when the process is killed are lost.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.flush_task = None
+
+
+    def enqueue(self, message):
+        self.pending.append(message)
+        if len(self.pending) >= settings.MESSAGE_WRITE_BEHIND_BATCH_SIZE:
+            asyncio.ensure_future(self.flush())
+        elif self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+
+    async def flush_later(self):
+        await asyncio.sleep(settings.MESSAGE_WRITE_BEHIND_FLUSH_INTERVAL)
+        self.flush_task = None
+        await self.flush()
+
+
+    async def flush(self):
+        """Writes all the queued messages."""
+        messages, self.pending = self.pending, []
+        if not messages:
+            return
+        try:
+            await database_sync_to_async(write_messages)(messages)
+        except DatabaseError:
+            # one bad message must not drop the whole batch
+            await database_sync_to_async(write_messages_one_by_one)(messages)
+
+
+_write_behind_queues = WeakKeyDictionary()
+
+
+def message_write_behind():
+    """Returns the write-behind queue of the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    if loop not in _write_behind_queues:
+        _write_behind_queues[loop] = MessageWriteBehind()
+    return _write_behind_queues[loop]
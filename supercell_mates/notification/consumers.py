@@ -0,0 +1,73 @@
+from json import dumps
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from .push import notification_group_name
+from .views import chats_with_new_messages
+
+
+class NotificationConsumer(AsyncWebsocketConsumer):
+    """Pushes the notifications of the current user, so that connected clients do not poll the notification views.
+    On connect, the chats with new messages are sent in the same format as the chats_new_messages view.
+    After that, an event is sent when a message is sent to one of the chats of the user by another user,
+    when another user sends a friend request to the user, and when another user accepts a friend request of the user.
+    Friend acceptances are still kept for the friends view, which clients call once when they start.
+
+    Available instance fields:
+    user: the UserAuth instance of the current user
+    group_name: the name of the channel layer group of the notification connections of the current user
+    channel_layer, channel_name: inherit from AsyncWebsocketConsumer
+    """
+
+    @database_sync_to_async
+    def get_chats_new_messages(self):
+        return {
+            "privates": chats_with_new_messages(self.user.private_chats.all(), self.user),
+            "groups": chats_with_new_messages(self.user.group_chats.all(), self.user),
+        }
+
+
+    async def connect(self):
+        """Called when a user attempts to connect."""
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            await self.close(code=4003)
+            return
+
+        self.group_name = notification_group_name(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        chats_new_messages = await self.get_chats_new_messages()
+        chats_new_messages["type"] = "chats_new_messages"
+        await self.send(text_data=dumps(chats_new_messages))
+
+
+    async def disconnect(self, close_code):
+        """Called when a user disconnects."""
+        if self.user.is_authenticated:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+
+    async def new_message(self, event):
+        """Called when a message is sent to one of the chats of the user."""
+        await self.send(text_data=dumps({
+            "type": "new_message",
+            "chat_type": event["chat_type"],
+            "chat_id": event["chat_id"],
+        }))
+
+
+    async def friend_request(self, event):
+        """Called when another user sends a friend request to the user."""
+        await self.send(text_data=dumps({
+            "type": "friend_request",
+            "user": event["user"],
+        }))
+
+
+    async def friend_accepted(self, event):
+        """Called when another user accepts a friend request of the user."""
+        await self.send(text_data=dumps({
+            "type": "friend_accepted",
+            "user": event["user"],
+        }))
@@ -0,0 +1,59 @@
+from django.urls import reverse
+
+from message.models import PrivateChat, GroupChat, GROUP_CHAT_MESSAGE_KINDS, message_kind
+from utils.realtime import group_send_on_commit
+
+
+def notification_group_name(user_id):
+    """Returns the name of the channel layer group of the notification connections of the user."""
+    return f"notifications_{user_id}"
+
+
+def user_info(user_auth_obj):
+    """Returns the information of the user sent in friend notifications, in the same format as notification.views.friends."""
+    return {
+        "name": user_auth_obj.user_profile.name,
+        "username": user_auth_obj.username,
+        "profile_link": reverse("user_log:view_profile", args=(user_auth_obj.username,)),
+        "profile_pic_url": reverse("user_profile:get_profile_pic", args=(user_auth_obj.username,)),
+    }
+
+
+def push_new_messages(messages):
+    """Notifies the members of the chats of the new messages, except the senders, with one query per chat model.
+
+    Args:
+        messages (list(AbstractMessage)): the newly created messages, of any kind
+    """
+    senders_of_chat = {}
+    for message in messages:
+        chat_type = "group" if message_kind(message) in GROUP_CHAT_MESSAGE_KINDS else "private"
+        senders_of_chat.setdefault((chat_type, message.chat_id), set()).add(message.user_id)
+
+    for chat_type, chat_model in (("private", PrivateChat), ("group", GroupChat)):
+        chat_ids = [chat_id for (message_chat_type, chat_id) in senders_of_chat if message_chat_type == chat_type]
+        if not chat_ids:
+            continue
+        for chat_id, user_id in chat_model.objects.filter(id__in=chat_ids, users__isnull=False).values_list("id", "users"):
+            if senders_of_chat[(chat_type, chat_id)] != {user_id}:
+                group_send_on_commit(notification_group_name(user_id), {
+                    "type": "new_message",
+                    "chat_type": chat_type,
+                    "chat_id": chat_id,
+                })
+
+
+def push_friend_request(from_user_auth, to_user_auth):
+    """Notifies the user receiving a friend request."""
+    group_send_on_commit(notification_group_name(to_user_auth.id), {
+        "type": "friend_request",
+        "user": user_info(from_user_auth),
+    })
+
+
+def push_friend_accepted(from_user_auth, to_user_auth):
+    """Notifies the user whose friend request is accepted, from_user_auth being the user accepting it."""
+    group_send_on_commit(notification_group_name(to_user_auth.id), {
+        "type": "friend_accepted",
+        "user": user_info(from_user_auth),
+    })
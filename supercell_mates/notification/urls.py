@@ -7,4 +7,5 @@ urlpatterns = [
     path('friends', views.friends, name='friends'),
     path('chats_new_messages', views.chats_new_messages, name='chats_new_messages'),
     path('see_message', views.see_message, name="see_message"),
+    path('get_seen_users', views.get_seen_users, name="get_seen_users"),
 ]
\ No newline at end of file
@@ -4,10 +4,14 @@ from django.urls import reverse
 from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.datastructures import MultiValueDictKeyError
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
 
+from user_auth.models import UserAuth
 from user_log.models import FriendRequest
 from .models import FriendNotification
-from message.models import PrivateChat, GroupChat, PrivateTextMessage, GroupTextMessage, PrivateFileMessage, GroupFileMessage, ReplyPostMessage
+from message.models import PrivateTextMessage, GroupTextMessage, PrivateFileMessage, GroupFileMessage, ReplyPostMessage, \
+    ChatReadCursor, advance_read_cursor
 
 
 @login_required
@@ -45,36 +49,22 @@ def friends(request):
     })
 
 
-def has_new_message(chat_obj, request_user):
-    """Returns whether the chat object has new messages, given the last seen.
+def chats_with_new_messages(chats, request_user):
+    """Returns the ids of the chats with messages after the read cursor of the user, in one query.
 
     Args:
-        chat_obj (AbstractChat): the chat object to check
-        request_user (UserAuth): the user that requested to see this chat
+        chats (QuerySet): the chats (of one chat model) to check
+        request_user (UserAuth): the user that requested to see these chats
     
     Returns:
-        bool: whether the chat has new message
+        list: the ids of the chats with new messages
     """
-
-    messages = [
-        chat_obj.text_messages,
-        chat_obj.file_messages
-    ]
-    if isinstance(chat_obj, PrivateChat):
-        messages.append(chat_obj.reply_post_messages)
-    
-    messages = list(map(lambda messages: messages.order_by("timestamp").last() if messages.exists() else None, messages))
-    latest_timestamp = 0
-    latest_message_i = -1
-    for i in range(len(messages)):
-        message = messages[i]
-        if message is not None:
-            if message.timestamp > latest_timestamp:
-                latest_timestamp = message.timestamp
-                latest_message_i = i 
-    if latest_message_i != -1:
-        return not messages[latest_message_i].seen_users.filter(username=request_user.username).exists()
-    return False
+    last_seen_timestamp = ChatReadCursor.objects.filter(chat_id=OuterRef("id"), user=request_user) \
+        .values("last_seen_timestamp")[:1]
+    return list(
+        chats.filter(last_message_timestamp__gt=Coalesce(Subquery(last_seen_timestamp), Value(0.0)))
+            .values_list("id", flat=True)
+    )
 
 
 @login_required
@@ -87,32 +77,43 @@ def chats_new_messages(request):
     Returns:
         HttpResponse: the http response containing information of number of chats with new messages
     """
-    privates = list(map(
-        lambda chat: chat.id,
-        filter(
-            lambda chat: has_new_message(chat, request.user),
-            request.user.private_chats.all()
-        )
-    ))
-
-    groups = list(map(
-        lambda chat: chat.id,
-        filter(
-            lambda chat: has_new_message(chat, request.user),
-            request.user.group_chats.all()
-        )
-    ))
-
     return JsonResponse({
-        "privates": privates,
-        "groups": groups
+        "privates": chats_with_new_messages(request.user.private_chats.all(), request.user),
+        "groups": chats_with_new_messages(request.user.group_chats.all(), request.user)
     })
 
 
+# message types in see_message and get_seen_users
+MESSAGE_TYPES = {
+    "text private": PrivateTextMessage,
+    "reply_post private": ReplyPostMessage,
+    "file private": PrivateFileMessage,
+    "text group": GroupTextMessage,
+    "file group": GroupFileMessage,
+}
+
+
+def get_message_of_type(message_type, message_id):
+    """Returns the message with the message id, given its type, or None if the type is not recognised.
+    Raises ObjectDoesNotExist if there is no message of the type with the message id.
+
+    Args:
+        message_type (str): the type of the message, which is one of the keys of MESSAGE_TYPES
+        message_id (str): the id of the message
+    
+    Returns:
+        AbstractMessage: the message found
+    """
+    if message_type not in MESSAGE_TYPES:
+        return None
+    return MESSAGE_TYPES[message_type].objects.get(id=message_id)
+
+
 @login_required
 @require_http_methods(["POST"])
 def see_message(request):
-    """Mark a chat message as viewed. The request body must contain the following fields:
+    """Mark a chat message, together with all messages before it in the chat, as viewed.
+    The request body must contain the following fields:
         message_id: the id of the message
         type: the type of the message, which is either 'text private', 'reply_post private', 'file private',
             'text group', 'file group'
@@ -125,26 +126,65 @@ def see_message(request):
     """
 
     try:
-        message_id = request.POST["message_id"]
-        message_type = request.POST["type"]
-        if message_type == "text private":
-            message = PrivateTextMessage.objects.get(id=message_id)
-        elif message_type == "text group":
-            message = GroupTextMessage.objects.get(id=message_id)
-        elif message_type == "file private":
-            message = PrivateFileMessage.objects.get(id=message_id)
-        elif message_type == "file group":
-            message = GroupFileMessage.objects.get(id=message_id)
-        elif message_type == "reply_post private":
-            message = ReplyPostMessage.objects.get(id=message_id)
-        else:
+        message = get_message_of_type(request.POST["type"], request.POST["message_id"])
+        if message is None:
             return HttpResponseBadRequest("type argument not recognised")
         if not message.chat.users.filter(username=request.user.username).exists():
             return HttpResponseBadRequest("how dare you obtained another person's message id")
-        message.seen_users.add(request.user)
+        advance_read_cursor(message.chat_id, request.user, message.timestamp)
         return HttpResponse("ok")
     
     except MultiValueDictKeyError:
         return HttpResponseBadRequest("request is missing an important key")
     except ObjectDoesNotExist:
-        return HttpResponseBadRequest("message with message id not found")
\ No newline at end of file
+        return HttpResponseBadRequest("message with message id not found")
+
+
+@login_required
+def get_seen_users(request):
+    """Returns the members of the chat, other than the sender, who have seen a message, derived from their read cursors.
+    GET parameters:
+        message_id: the id of the message
+        type: the type of the message, which is either 'text private', 'reply_post private', 'file private',
+            'text group', 'file group'
+    The JSON response contains the following fields:
+        users: the list of users that have seen the message, each has the following fields:
+            name: the name of the user,
+            username: the username of the user,
+            profile_link: link to profile page of the user,
+            profile_pic_url: URL to profile pic of the user,
+
+    Args:
+        request (HttpRequest): the request made to this view
+    
+    Returns:
+        JsonResponse: the list of users that have seen the message
+    """
+
+    try:
+        message = get_message_of_type(request.GET["type"], request.GET["message_id"])
+        if message is None:
+            return HttpResponseBadRequest("type argument not recognised")
+        if not message.chat.users.filter(username=request.user.username).exists():
+            return HttpResponseBadRequest("how dare you obtained another person's message id")
+        seen_users = UserAuth.objects.filter(
+            id__in=message.chat.users.values("id"),
+            chat_read_cursors__chat_id=message.chat_id,
+            chat_read_cursors__last_seen_timestamp__gte=message.timestamp
+        ).exclude(id=message.user_id).select_related("user_profile")
+        return JsonResponse({
+            "users": list(map(
+                lambda user_auth_obj: {
+                    "name": user_auth_obj.user_profile.name,
+                    "username": user_auth_obj.username,
+                    "profile_link": reverse("user_log:view_profile", args=(user_auth_obj.username,)),
+                    "profile_pic_url": reverse("user_profile:get_profile_pic", args=(user_auth_obj.username,)),
+                },
+                seen_users
+            ))
+        })
+    
+    except MultiValueDictKeyError:
+        return HttpResponseBadRequest("request is missing an important key")
+    except ObjectDoesNotExist:
+        return HttpResponseBadRequest("message with message id not found")
@@ -0,0 +1,132 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.contrib.auth.hashers import make_password
+from datetime import datetime
+import random
+import time
+
+from user_auth.models import UserAuth, Tag
+from user_profile.models import UserProfile, TagActivityRecord
+from user_log.models import UserLog
+from posts.models import Post
+from message.models import PrivateChat, GroupChat, PrivateTextMessage, ReplyPostMessage, GroupTextMessage, \
+    PrivateFileMessage, GroupFileMessage
+
+INDEXED_MODELS = (Post, TagActivityRecord, PrivateTextMessage, ReplyPostMessage, GroupTextMessage,
+                  PrivateFileMessage, GroupFileMessage)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Seed a throwaway dataset and print the query plans of the timestamp range queries, " \
+        "without and with the indexes declared on the models. Nothing is left in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--posts", type=int, default=20000)
+        parser.add_argument("--messages", type=int, default=20000)
+        parser.add_argument("--repeat", type=int, default=20, help="number of runs to average the timing over")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                context = self.seed(options["users"], options["posts"], options["messages"])
+                self.analyze()
+                self.set_indexes(False)
+                self.report("without indexes", context, options["repeat"])
+                self.set_indexes(True)
+                self.report("with indexes", context, options["repeat"])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def seed(self, user_count, post_count, message_count):
+        random.seed(0)
+        now = datetime.now().timestamp()
+        password = make_password(None)
+
+        # the seeded rows are used as bulk_create returns them with their ids, as selecting them by name could
+        # also select the tags and users that are already in the database, and the usernames contain "-",
+        # which the usernames of the signed up users cannot contain, see user_auth.views.create_account
+        tags = Tag.objects.bulk_create([Tag(name=f"benchmark{i}") for i in range(20)])
+        users = UserAuth.objects.bulk_create([UserAuth(username=f"benchmark-{i}", password=password) for i in range(user_count)])
+        profiles = UserProfile.objects.bulk_create([UserProfile(name=user.username, user_auth=user) for user in users])
+        logs = UserLog.objects.bulk_create([UserLog(user_auth=user, user_profile=profile) for user, profile in zip(users, profiles)])
+        TagActivityRecord.objects.bulk_create([
+            TagActivityRecord(user_profile=profile, tag=tag, last_activity_timestamp=now)
+            for profile in profiles for tag in random.sample(tags, 4)
+        ])
+
+        Post.objects.bulk_create([
+            Post(title="benchmark", content="benchmark", tag=random.choice(tags), friend_visible=False,
+                 tag_visible=False, public_visible=True, creator=random.choice(logs),
+                 time_posted=now - i * 60)
+            for i in range(post_count)
+        ])
+
+        private_chats = [PrivateChat.objects.create(timestamp=now) for _ in range(20)]
+        group_chats = [GroupChat.objects.create(timestamp=now, name="benchmark") for _ in range(20)]
+        for model, chats in ((PrivateTextMessage, private_chats), (GroupTextMessage, group_chats)):
+            model.objects.bulk_create([
+                model(timestamp=now - i * 10, text="benchmark", chat=random.choice(chats), user=random.choice(users))
+                for i in range(message_count)
+            ])
+
+        return {
+            "now": now,
+            "user": users[0],
+            "log": logs[0],
+            "profile": profiles[0],
+            "tags": tags[:4],
+            "private_chat": private_chats[0],
+            "group_chat": group_chats[0],
+        }
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def set_indexes(self, present):
+        schema_editor = connection.schema_editor()
+        with connection.cursor() as cursor:
+            for model in INDEXED_MODELS:
+                existing = connection.introspection.get_constraints(cursor, model._meta.db_table)
+                for index in model._meta.indexes:
+                    if present and index.name not in existing:
+                        cursor.execute(str(index.create_sql(model, schema_editor)))
+                    elif not present and index.name in existing:
+                        cursor.execute(str(index.remove_sql(model, schema_editor)))
+        self.analyze()
+
+    def queries(self, context):
+        now = context["now"]
+        return {
+            "home feed by time": Post.objects.filter(time_posted__lt=now - 3600).order_by("-time_posted")[:20],
+            "profile posts in a day": Post.objects.filter(creator=context["log"], time_posted__range=(now - 86400, now))
+                .order_by("-time_posted"),
+            "older profile post": Post.objects.filter(creator=context["log"], time_posted__lt=now - 86400)
+                .order_by("-time_posted")[:1],
+            "home feed of tags": Post.objects.filter(tag__in=context["tags"], time_posted__lt=now - 3600)
+                .order_by("-time_posted")[:20],
+            "recommendation candidates": Post.objects.filter(time_posted__gt=now - 15 * 86400),
+            "private chat messages in a day": PrivateTextMessage.objects.filter(
+                chat=context["private_chat"], timestamp__range=(now - 86400, now)),
+            "group chat older message": GroupTextMessage.objects.filter(
+                chat=context["group_chat"], timestamp__lt=now - 86400).order_by("-timestamp")[:1],
+            "tag activity record": TagActivityRecord.objects.filter(
+                user_profile=context["profile"], tag=context["tags"][0]),
+        }
+
+    def report(self, title, context, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"=== {title} ==="))
+        for name, queryset in self.queries(context).items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                list(queryset.all())
+            elapsed = (time.perf_counter() - start) / repeat * 1000
+            self.stdout.write(self.style.MIGRATE_LABEL(f"{name} ({elapsed:.2f} ms)"))
+            self.stdout.write(queryset.explain())
+        self.stdout.write("")
@@ -0,0 +1,25 @@
+# Generated by Django 4.0.4 on 2026-10-17 02:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['time_posted'], name='post_time_posted_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['creator', 'time_posted'], name='post_creator_time_posted_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['tag', 'time_posted'], name='post_tag_time_posted_idx'),
+        ),
+    ]
@@ -18,6 +18,13 @@ class Post(models.Model):
     time_posted = models.FloatField()
     img_count = models.IntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["time_posted"], name="post_time_posted_idx"),
+            models.Index(fields=["creator", "time_posted"], name="post_creator_time_posted_idx"),
+            models.Index(fields=["tag", "time_posted"], name="post_tag_time_posted_idx"),
+        ]
+
 
 class PostImage(models.Model):
     id = models.CharField(unique=True, primary_key=True, default=random_str, max_length=50)
@@ -1,3 +1,129 @@
+import io
+import os
+import shutil
+import tempfile
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase
 
-# Create your tests here.
+from user_auth.models import UserAuth, Tag
+from user_profile.models import UserProfile
+from user_profile.views import attach_tag_to_user
+from user_log.models import UserLog
+from .models import Post
+from .views import accessible_posts, has_access
+
+
+def create_user(username, tags=()):
+    user = UserAuth.objects.create_user(username=username, password="password")
+    user_profile_obj = UserProfile.objects.create(name=username, user_auth=user)
+    UserLog.objects.create(user_auth=user, user_profile=user_profile_obj)
+    for tag in tags:
+        attach_tag_to_user(user_profile_obj, tag)
+    return user
+
+
+def image_file(name, size):
+    """Returns a PNG image of random pixels, which is about 3 * size * size bytes, as PNG cannot compress it."""
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (size, size), os.urandom(3 * size * size)).save(buffer, "PNG")
+    return SimpleUploadedFile(name, buffer.getvalue(), "image/png")
+
+
+class UploadSizeLimitTest(TestCase):
+    """A request with a file over settings.UPLOAD_STREAM_MAX_SIZE must be rejected, rather than handled without that file."""
+
+    def setUp(self):
+        self.tag = Tag.objects.create(name="tag")
+        self.user = create_user("user", [self.tag])
+        self.client.force_login(self.user)
+        self.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def create_post(self, imgs):
+        with self.settings(MEDIA_ROOT=self.media_root, UPLOAD_STREAM_MAX_SIZE=10000):
+            return self.client.post("/post/create_post", {
+                "title": "title",
+                "content": "content",
+                "tag": self.tag.name,
+                "visibility": ["public"],
+                "imgs": imgs,
+            }, HTTP_HOST="localhost")
+
+    def test_images_within_limit(self):
+        response = self.create_post([image_file("small1.png", 8), image_file("small2.png", 8)])
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(Post.objects.get().images.count(), 2)
+
+    def test_image_over_limit(self):
+        response = self.create_post([image_file("small.png", 8), image_file("large.png", 100)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b"file too large")
+        self.assertFalse(Post.objects.exists())
+
+
+class AccessiblePostsTest(TestCase):
+    """accessible_posts must select exactly the posts for which has_access is True."""
+
+    def setUp(self):
+        self.shared_tag = Tag.objects.create(name="shared")
+        self.other_tag = Tag.objects.create(name="other")
+        self.viewer = create_user("viewer", [self.shared_tag])
+        friend = create_user("friend", [self.shared_tag, self.other_tag])
+        stranger = create_user("stranger", [self.shared_tag, self.other_tag])
+        self.viewer.user_log.friend_list.add(friend.user_log)
+
+        for creator in (self.viewer, friend, stranger):
+            for tag in (self.shared_tag, self.other_tag):
+                for visibility in range(8):
+                    Post.objects.create(
+                        title="title", content="content", tag=tag, creator=creator.user_log, time_posted=0,
+                        friend_visible=bool(visibility & 1), tag_visible=bool(visibility & 2), public_visible=bool(visibility & 4)
+                    )
+
+    def test_matches_has_access(self):
+        expected = {post.id for post in Post.objects.all() if has_access(self.viewer, post)}
+        self.assertEqual(set(accessible_posts(self.viewer).values_list("id", flat=True)), expected)
+        # the posts of the stranger that are not public must not be accessible
+        self.assertLess(len(expected), Post.objects.count())
+
+
+class EditPostImagesTest(TestCase):
+    """image_order must only refer to each new image once, by its index in imgs written without leading zeros."""
+
+    def setUp(self):
+        self.tag = Tag.objects.create(name="tag")
+        self.user = create_user("user", [self.tag])
+        self.client.force_login(self.user)
+        self.post = Post.objects.create(
+            title="title", content="content", tag=self.tag, public_visible=True, friend_visible=False, tag_visible=False,
+            creator=self.user.user_log, time_posted=0
+        )
+        self.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def edit_post(self, image_order):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            return self.client.post(f"/post/post/edit/{self.post.id}", {
+                "title": "title",
+                "content": "content",
+                "visibility": ["public"],
+                "imgs": [image_file("first.png", 8), image_file("second.png", 8)],
+                "image_order": image_order,
+            }, HTTP_HOST="localhost")
+
+    def test_new_images(self):
+        response = self.edit_post(["new:1", "new:0"])
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.post.images.count(), 2)
+
+    def test_invalid_new_image_refs(self):
+        for image_order in (["new:-1"], ["new:2"], ["new:00"], ["new:0", "new:00"], ["new:1", "new:01"], ["new:+1"], ["new: 1"]):
+            with self.subTest(image_order=image_order):
+                response = self.edit_post(image_order)
+                self.assertEqual(response.status_code, 400)
+                self.assertFalse(self.post.images.exists())
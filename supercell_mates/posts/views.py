@@ -2,22 +2,30 @@ from django.shortcuts import render
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.utils.datastructures import MultiValueDictKeyError
-from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, HttpResponseNotFound, FileResponse
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, HttpResponseNotFound
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.cache import cache
+from django.db.models import Q, F, Prefetch, prefetch_related_objects
 import io
+import os
+import re
 from django.core.files.images import ImageFile
 from datetime import datetime
 import json
-import heapq
+from concurrent.futures import ThreadPoolExecutor
+from django.db import transaction
 
 from user_profile.views import verify_image, list_to_image_and_verify_async, \
     get_tag_activity_record, change_activity_score, compute_tag_activity_final_score, MAXIMUM_ACTIVITY_SCORE
-from user_log.views import compute_matching_index
 from utils.user import can_view_profile
+from utils.social_graph import SocialGraph, social_graph
+from utils.media import image_file_response, versioned_media_url
+from utils.upload import reject_oversized_uploads
 
 from user_auth.models import Tag, UserAuth
+from user_profile.models import TagActivityRecord
 from .models import Post, PostImage
 
 CREATE_POST_TAG_ACTIVITY_COEFFICIENT = 0.5
@@ -25,22 +33,99 @@ DELETE_POST_MAXIMUM_PUNISHMENT = -1
 POST_EXP_COEFFICIENT = 1.05
 SECONDS_IN_A_DAY = 24 * 3600
 RECOMMENDED_POSTS_DAY_RANGE = 15
+RANKED_FEED_CACHE_TIMEOUT = 15 * 60 # seconds
+MAX_POST_IMAGES = 9
 
 TOTAL_POST_COUNT_1 = 20
 TOTAL_POST_COUNT_2 = 50
 TAG_ACTIVITY_SCORE_1 = 4.3
 TAG_ACTIVITY_SCORE_2 = 4.7
 
+# relations needed to serialize a post, see parse_post_objects
+POST_RELATED_FIELDS = ("tag", "creator__user_profile", "creator__user_auth")
+
+# reference to the new image at an index in image_order, see update_post_images, with the index written without leading zeros
+NEW_IMAGE_REF = re.compile(r"new:(0|[1-9][0-9]*)")
+
+
+def get_post_images(request):
+    """Return the images submitted with a post, verified concurrently, or a string if there is an error.
+    The images are either a JSON list of byte lists under the "imgs" field of the body, or files under "imgs".
+
+    Args:
+        request (HttpRequest): the request to extract the images from
+    
+    Returns:
+        list/str: the verified image files, or a string if there are too many images or one of them is not an image
+    """
+    if "imgs" in request.POST:
+        imgs = json.loads(request.POST["imgs"])
+        # do not change the method of getting the list of imgs
+        verify = lambda img_uint8list: list_to_image_and_verify_async(img_uint8list, request.user.username)
+    else:
+        imgs = request.FILES.getlist("imgs")
+        verify = lambda img: img if verify_image(img) else "not image"
+
+    if len(imgs) > MAX_POST_IMAGES:
+        return "too many images"
+    if not imgs:
+        return []
+    with ThreadPoolExecutor(max_workers=len(imgs)) as executor:
+        images = list(executor.map(verify, imgs))
+    if "not image" in images:
+        return "not image"
+    return images
+
+
+def store_post_images(post, images, first_order=0):
+    """Upload the images of a post to storage concurrently, without saving the PostImage rows.
+    Each image is stored under the id of its PostImage, which is a random UUID, rather than under the name it was uploaded with,
+    as concurrent uploads of the same name could overwrite each other (e.g. images from mobile are named after the user).
+    If one of the uploads fails, the images already uploaded are deleted from storage before the error is raised.
+
+    Args:
+        post (Post): the post of the images
+        images (list(File)): the verified image files, in order
+        first_order (int): the order of the first image in the post
+    
+    Returns:
+        list(PostImage): the unsaved PostImage instances of the uploaded images, to be saved with bulk_create
+    """
+    image_objs = list(map(lambda i: PostImage(order=first_order + i, post=post), range(len(images))))
+    if not images:
+        return image_objs
+
+    def store(image_obj_and_image):
+        image_obj, image = image_obj_and_image
+        image_obj.image.save(image_obj.id + os.path.splitext(image.name or "")[1], image, save=False)
+
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        futures = list(map(lambda pair: executor.submit(store, pair), zip(image_objs, images)))
+    errors = list(filter(None, map(lambda future: future.exception(), futures)))
+    if errors:
+        delete_stored_images(image_objs)
+        raise errors[0]
+    return image_objs
+
+
+def delete_stored_images(image_objs):
+    """Delete the files of the PostImage instances from storage, if they were uploaded."""
+    for image_obj in image_objs:
+        if image_obj.image:
+            image_obj.image.storage.delete(image_obj.image.name)
+
 
 @login_required
 @require_http_methods(["POST"])
+@reject_oversized_uploads
 def create_post(request):
     """Create a post via request post method.
     The request body must be of form data, and contains the following fields:
         title (compulsory): the title of the post.
         content (compulsory): the text content of the post.
         tag (compulsory): the tag name associated with this post. There can only be one tag associated
-        imgs (optional): the list of images associated with this post.
+        imgs (optional): the list of images associated with this post, at most MAX_POST_IMAGES.
+            The images are verified and uploaded concurrently, and the post is only created if all of them succeed.
         visibility (compulsory): the list of the visibility options. Values:
             "public": the post is visible to public
             "friends": the post is visible to friends
@@ -85,6 +170,11 @@ def create_post(request):
         if not friend_visible and not tag_visible and not public_visible:
             return HttpResponseBadRequest("visibility malformed")
         
+        # images: verified, then uploaded, before anything is written to the database
+        images = get_post_images(request)
+        if type(images) == str:
+            return HttpResponseBadRequest(images)
+
         post = Post(
             title=title, 
             content=content, 
@@ -93,34 +183,17 @@ def create_post(request):
             tag_visible=tag_visible, 
             public_visible=public_visible,
             creator=request.user.user_log,
-            time_posted=datetime.now().timestamp()
+            time_posted=datetime.now().timestamp(),
+            img_count=len(images)
         )
-        post.save()
-
-        # images
-        if "imgs" in request.POST:
-            imgs = json.loads(request.POST["imgs"])
-            # do not change the method of getting the list of imgs
-
-            if len(imgs) > 9:
-                return HttpResponseBadRequest("too many images")
-            for (i, img_uint8list) in enumerate(imgs):
-                img = list_to_image_and_verify_async(img_uint8list, request.user.username)
-                if img == "not image":
-                    return HttpResponseBadRequest("not image")
-                img_obj = PostImage(order=i, image=img, post=post)
-                img_obj.save()
-        else:
-            imgs = request.FILES.getlist("imgs")
-            if len(imgs) > 9:
-                return HttpResponseBadRequest("too many images")
-            for (i, img) in enumerate(imgs):
-                if not verify_image(img):
-                    return HttpResponseBadRequest("not image")
-                img_obj = PostImage(order=i, image=img, post=post)
-                img_obj.save()
-        post.img_count = len(imgs)
-        post.save()
+        image_objs = store_post_images(post, images)
+        try:
+            with transaction.atomic():
+                post.save()
+                PostImage.objects.bulk_create(image_objs)
+        except Exception:
+            delete_stored_images(image_objs)
+            raise
 
         # update tag activity
         record_obj = get_tag_activity_record(request.user, tag_object)
@@ -205,18 +278,83 @@ def get_list_from_request_body(request, key):
         return HttpResponseBadRequest("request is malformed")
 
 
+def update_post_images(request, post, image_order):
+    """Update the images of the post to those in image_order, keeping the existing images that are still listed,
+    deleting the others, and uploading the new images in the request (see get_post_images) that are listed.
+    The image rows are changed in one transaction, with the order of the kept images updated in bulk.
+
+    Args:
+        request (HttpRequest): the request containing the new images
+        post (Post): the post to update, which is saved together with the images
+        image_order (list(str)): the images of the post after the update, each being either the id of an existing image of the post,
+            or "new:<i>" for the new image at index i, with 0 <= i < the number of new images, each new image listed at most once
+    
+    Returns:
+        str: the error if image_order or the new images are malformed, otherwise None
+    """
+    if len(image_order) > MAX_POST_IMAGES:
+        return "too many images"
+    if len(set(image_order)) != len(image_order):
+        return "image_order contains duplicates"
+    new_images = get_post_images(request)
+    if type(new_images) == str:
+        return new_images
+
+    existing_images = {image.id: image for image in post.images.all()}
+    kept_images = []
+    new_image_orders = []
+    new_image_indices = set()
+    for (order, image_ref) in enumerate(image_order):
+        if image_ref.startswith("new:"):
+            new_image_ref = NEW_IMAGE_REF.fullmatch(image_ref)
+            if new_image_ref is None:
+                return "image_order contains a malformed new image reference"
+            index = int(new_image_ref.group(1))
+            if index >= len(new_images):
+                return "image_order refers to a new image that is not provided"
+            if index in new_image_indices:
+                return "image_order contains duplicates"
+            new_image_indices.add(index)
+            new_image_orders.append((order, new_images[index]))
+        elif image_ref in existing_images:
+            image_obj = existing_images[image_ref]
+            image_obj.order = order
+            kept_images.append(image_obj)
+        else:
+            return "image_order refers to an image not in this post"
+
+    added_images = store_post_images(post, list(map(lambda order_and_image: order_and_image[1], new_image_orders)))
+    for (image_obj, (order, _)) in zip(added_images, new_image_orders):
+        image_obj.order = order
+    try:
+        with transaction.atomic():
+            PostImage.objects.filter(post=post).exclude(id__in=list(map(lambda image: image.id, kept_images))).delete()
+            PostImage.objects.bulk_update(kept_images, ["order"])
+            PostImage.objects.bulk_create(added_images)
+            post.img_count = len(image_order)
+            post.save()
+    except Exception:
+        delete_stored_images(added_images)
+        raise
+    return None
+
+
 @login_required
 @require_http_methods(["POST"])
+@reject_oversized_uploads
 def edit_post(request, post_id):
-    """Allow user to edit the post, with the new information given in the body, except images will not be received. 
-    Removing/adding photos to posts are handled in a separate view.
+    """Allow user to edit the post, with the new information given in the body.
     Tag will not be changed.
-    All old images will be deleted, frontend needs to keep track of the old images
     Required fields in the form data of the request:
         title: the new title of the post
         content: the new content of the post
         visibility: the new visibility list of the post
         imgs: the list of new images attached to this post
+    Optional fields in the form data of the request:
+        image_order: the list of images of the post after the edit, in order, each being either the id of an existing image
+            of the post, or "new:<i>" for the image at index i of imgs. Existing images not in the list are deleted,
+            and only the images in imgs are uploaded. See update_post_images.
+    If image_order is not provided, all old images will be deleted and replaced by imgs, so frontend needs to keep track of the old images.
     
     Args:
         request (HttpRequest): the request made to this view
@@ -256,26 +394,25 @@ def edit_post(request, post_id):
         post.public_visible = public_visible
         
         # images
-        for img in post.images.all():
-            img.delete()
-        if "imgs" in request.POST:
-            imgs = json.loads(request.POST["imgs"])
-
-            for i, img_uint8list in enumerate(imgs):
-                img = list_to_image_and_verify_async(img_uint8list, request.user.username)
-                if img == "not image":
-                    return HttpResponseBadRequest("not image")
-                img_obj = PostImage(order=i, image=img, post=post)
-                img_obj.save()
+        if "image_order" in request.POST or "image_order_async" in request.POST:
+            image_order = list(filter(None, get_list_from_request_body(request, "image_order")))
+            error = update_post_images(request, post, image_order)
+            if error is not None:
+                return HttpResponseBadRequest(error)
         else:
-            imgs = request.FILES.getlist("imgs")
-            for (i, img) in enumerate(imgs):
-                if not verify_image(img):
-                    return HttpResponseBadRequest("not image")
-                img_obj = PostImage(order=i, image=img, post=post)
-                img_obj.save()
-        post.img_count = len(imgs)
-        post.save()
+            images = get_post_images(request)
+            if type(images) == str:
+                return HttpResponseBadRequest(images)
+            image_objs = store_post_images(post, images)
+            try:
+                with transaction.atomic():
+                    post.images.all().delete()
+                    PostImage.objects.bulk_create(image_objs)
+                    post.img_count = len(image_objs)
+                    post.save()
+            except Exception:
+                delete_stored_images(image_objs)
+                raise
 
         return HttpResponse("post updated")
 
@@ -329,7 +466,7 @@ def total_num_of_posts(request):
     """
     try:
         username = request.GET["username"]
-        if request.user.username != username and not can_view_profile(request.user, username):
+        if request.user.username != username and not can_view_profile(request.user, username, social_graph(request)):
             return HttpResponseBadRequest("no viewing privilege")
         
         count = UserAuth.objects.get(username=username).user_log.posts.count()
@@ -374,7 +511,7 @@ def post_frequencies(request):
     """
     try:
         username = request.GET["username"]
-        if request.user.username != username and not can_view_profile(request.user, username):
+        if request.user.username != username and not can_view_profile(request.user, username, social_graph(request)):
             return HttpResponseBadRequest("no viewing privilege")
         
         posts = UserAuth.objects.get(username=username).user_log.posts
@@ -395,30 +532,105 @@ def post_frequencies(request):
         return HttpResponseBadRequest("request does not contain username param")
 
 
-def compute_matching_index_with_post(user_auth_obj, post_obj, timestamp):
-    if user_auth_obj == post_obj.creator.user_auth:
-        return 0
-    tag_obj = post_obj.tag
-    if tag_obj not in user_auth_obj.user_profile.tagList.all():
-        my_tag_score = 0
-    else:
-        my_tag_score = compute_tag_activity_final_score(get_tag_activity_record(user_auth_obj, tag_obj),
-                                                        update=False, timestamp=timestamp)
-    if tag_obj not in post_obj.creator.user_profile.tagList.all():
-        post_creator_score = 0
-    else:
-        post_creator_score = compute_tag_activity_final_score(get_tag_activity_record(post_obj.creator.user_auth, tag_obj),
-                                                              update=False, timestamp=timestamp)
-    time_since_time_posted = (timestamp - post_obj.time_posted) / SECONDS_IN_A_DAY
-    raw_result = (my_tag_score + post_creator_score) / 2 * max(2 - POST_EXP_COEFFICIENT ** time_since_time_posted, 0)
-    return round(raw_result, 10)
+def compute_matching_indices_with_posts(user_auth_obj, posts, timestamp):
+    """Computes the matching index between the user and each of the posts at the given timestamp.
+    The tag activity records of the user and of all the creators are loaded in one query,
+    and each post is scored once, without updating any record.
+
+    Args:
+        user_auth_obj (UserAuth): the user to compute the matching indices for
+        posts (list(Post)): the posts to score, preferably with their creators selected
+        timestamp (float): the epoch time at which the scores are computed
+
+    Returns:
+        dict: the matching index of each post, keyed by post id, computed with formula:
+            (user's final score + creator's final score with the tag of the post) / 2
+            * max(2 - POST_EXP_COEFFICIENT ** days since the post was created, 0)
+            where a final score is 0 if the user does not have the tag of the post
+    """
+    profile_ids = {user_auth_obj.pk} | {post.creator.user_profile_id for post in posts}
+    tag_ids = {post.tag_id for post in posts}
+
+    # only records of tags that are still attached to the profile count
+    final_scores = {
+        (record.user_profile_id, record.tag_id): compute_tag_activity_final_score(record, update=False, timestamp=timestamp)
+        for record in TagActivityRecord.objects.filter(
+            user_profile_id__in=profile_ids,
+            tag_id__in=tag_ids,
+            tag__user_profiles=F("user_profile_id"),
+        )
+    }
+
+    result = {}
+    for post in posts:
+        if post.id in result:
+            continue
+        if post.creator.user_auth_id == user_auth_obj.pk:
+            result[post.id] = 0
+            continue
+        my_tag_score = final_scores.get((user_auth_obj.pk, post.tag_id), 0)
+        post_creator_score = final_scores.get((post.creator.user_profile_id, post.tag_id), 0)
+        time_since_time_posted = (timestamp - post.time_posted) / SECONDS_IN_A_DAY
+        raw_result = (my_tag_score + post_creator_score) / 2 * max(2 - POST_EXP_COEFFICIENT ** time_since_time_posted, 0)
+        result[post.id] = round(raw_result, 10)
+    return result
+
+
+def rank_recommended_posts(user_auth_obj, posts, timestamp):
+    """Ranks the posts by their matching index with the user, computing each index only once.
 
+    Args:
+        user_auth_obj (UserAuth): the user to recommend the posts to
+        posts (QuerySet): the candidate posts, already filtered by visibility
+        timestamp (float): the epoch time at which the matching indices are frozen
+
+    Returns:
+        list(tuple): (post id, matching index) of every candidate post, by decreasing matching index.
+        Posts with the same matching index are ranked newest first.
+    """
+    posts = list(posts.select_related("creator").order_by("-time_posted"))
+    matching_indices = compute_matching_indices_with_posts(user_auth_obj, posts, timestamp)
+    ranking = [(post.id, matching_indices[post.id]) for post in posts]
+    ranking.sort(key=lambda entry: entry[1], reverse=True)
+    return ranking
+
+
+def ranked_feed_cache_key(user_auth_obj, initial_timestamp, friend_filter, tag_filter):
+    """Returns the key under which the ranking of recommended posts of a feed session is cached.
+    A feed session is identified by the user, the initial timestamp and the filters applied.
+    """
+    return f"ranked_feed:{user_auth_obj.pk}:{initial_timestamp!r}:{friend_filter}:{tag_filter}"
+
+
+def get_ranked_posts_page(ranking, start_index, limit):
+    """Returns the next page of a ranking returned by rank_recommended_posts.
 
-def parse_post_object(post, user_auth_viewer):
+    Args:
+        ranking (list(tuple)): the (post id, matching index) pairs by decreasing matching index
+        start_index (float): only posts with matching index strictly smaller than this are returned
+        limit (int): the maximum number of posts to return
+
+    Returns:
+        list(tuple): the (post id, matching index) pairs of the page
+    """
+    # binary search for the first post with matching index smaller than start_index
+    low, high = 0, len(ranking)
+    while low < high:
+        mid = (low + high) // 2
+        if ranking[mid][1] < start_index:
+            high = mid
+        else:
+            low = mid + 1
+    return ranking[low:low + limit]
+
+
+def parse_post_object(post, user_auth_viewer, snapshot=None):
     """Return the information of the post by a dict.
 
     Args:
         post (Post): post in the database
+        user_auth_viewer (UserAuth): the user viewing the post
+        snapshot (SocialGraph): the social graph snapshot to read the friends of the viewer from, a new one by default
     
     Returns:
         (dict): the information of the post, with the following fields:
@@ -436,62 +648,124 @@ def parse_post_object(post, user_auth_viewer):
                 profile_link: the link to the profile of the creator
             time_posted: the time posted given in epoch time (in seconds)
             images: the list of URL to the images of the post
+            can_reply: whether the viewer is friend with the creator of the post
     """
-    images = list(PostImage.objects.filter(post=post))
-    images.sort(key=lambda image:image.order)
-    images = list(map(
-        lambda image: reverse("posts:get_post_pic", args=(image.id,)),
-        images
-    ))
-
-    ret = {
-        "id": post.id,
-        "title": post.title,
-        "content": post.content,
-        "tag": {
-            "name": post.tag.name,
-            "icon": reverse("user_profile:get_tag_icon", args=(post.tag.id,)),
-        },
-        "public_visible": post.public_visible,
-        "friend_visible": post.friend_visible,
-        "tag_visible": post.tag_visible,
-        "creator": {
-            "name": post.creator.user_profile.name,
-            "username": post.creator.user_auth.username,
-            "profile_pic_url": reverse("user_profile:get_profile_pic", args=(post.creator.user_auth.username,)),
-            "profile_link": reverse("user_log:view_profile", args=(post.creator.user_auth.username,)),
-        },
-        "time_posted": post.time_posted,
-        "images": images,
-        "can_reply": post.creator.friend_list.filter(user_auth=user_auth_viewer).exists(),
-    }
+    return parse_post_objects([post], user_auth_viewer, snapshot)[0]
+
 
-    return ret
+def parse_post_objects(posts, user_auth_viewer, snapshot=None):
+    """Return the information of each of the posts, in the same format as parse_post_object.
+    Images, tags and creators of all the posts, as well as the friends of the viewer,
+    are loaded in bulk, so the number of queries does not grow with the number of posts.
 
+    Args:
+        posts (iterable(Post)): the posts in the database
+        user_auth_viewer (UserAuth): the user viewing the posts
+        snapshot (SocialGraph): the social graph snapshot to read the friends of the viewer from, a new one by default
+
+    Returns:
+        list(dict): the information of the posts, in the same order as the given posts
+    """
+    posts = list(posts)
+    prefetch_related_objects(
+        posts,
+        *POST_RELATED_FIELDS,
+        Prefetch("images", queryset=PostImage.objects.order_by("order")),
+    )
+    friend_ids = (snapshot or SocialGraph()).friend_ids(user_auth_viewer) if posts else frozenset()
+
+    result = []
+    for post in posts:
+        creator_username = post.creator.user_auth.username
+        result.append({
+            "id": post.id,
+            "title": post.title,
+            "content": post.content,
+            "tag": {
+                "name": post.tag.name,
+                "icon": versioned_media_url(reverse("user_profile:get_tag_icon", args=(post.tag.id,)), post.tag.image.name),
+            },
+            "public_visible": post.public_visible,
+            "friend_visible": post.friend_visible,
+            "tag_visible": post.tag_visible,
+            "creator": {
+                "name": post.creator.user_profile.name,
+                "username": creator_username,
+                "profile_pic_url": versioned_media_url(
+                    reverse("user_profile:get_profile_pic", args=(creator_username,)), post.creator.user_profile.profile_pic.name
+                ),
+                "profile_link": reverse("user_log:view_profile", args=(creator_username,)),
+            },
+            "time_posted": post.time_posted,
+            "images": list(map(
+                lambda image: versioned_media_url(reverse("posts:get_post_pic", args=(image.id,)), image.image.name),
+                post.images.all()
+            )),
+            "can_reply": post.creator_id in friend_ids,
+        })
+    return result
 
-def has_access(user_auth_obj, post):
+
+def has_access(user_auth_obj, post, snapshot=None):
     """Determine if the user represented by the user auth object has privilege to view the post.
 
     Args:
         user_auth_obj (UserAuth): the UserLog instance representing the user
         post (Post): the post in the database
+        snapshot (SocialGraph): the social graph snapshot to read the friends and tags of the user from, a new one by default
     
     Returns:
         bool: True if the user has access to view the post, false otherwise
     """
-    if user_auth_obj == post.creator.user_auth:
+    if user_auth_obj.id == post.creator.user_auth_id:
         return True
     
     if post.public_visible:
         return True
     
+    snapshot = snapshot or SocialGraph()
     if post.friend_visible:
         if post.tag_visible:
-            return user_auth_obj.user_log in post.creator.friend_list.all() and post.tag in user_auth_obj.user_profile.tagList.all()
+            return post.creator_id in snapshot.friend_ids(user_auth_obj) and post.tag_id in snapshot.tag_ids(user_auth_obj)
         else:
-            return user_auth_obj.user_log in post.creator.friend_list.all()
+            return post.creator_id in snapshot.friend_ids(user_auth_obj)
     elif post.tag_visible:
-        return post.tag in user_auth_obj.user_profile.tagList.all()
+        return post.tag_id in snapshot.tag_ids(user_auth_obj)
+
+
+def accessible_posts_filter(user_auth_obj, snapshot=None):
+    """Returns the query equivalent of has_access, so that visibility is checked by the database.
+    The friend ids and tag ids of the user are read from the snapshot, instead of once per post.
+
+    Args:
+        user_auth_obj (UserAuth): the UserAuth instance representing the viewer
+        snapshot (SocialGraph): the social graph snapshot to read the friends and tags of the viewer from, a new one by default
+
+    Returns:
+        Q: the predicate selecting the posts that the user has privilege to view
+    """
+    snapshot = snapshot or SocialGraph()
+    friend_ids = snapshot.friend_ids(user_auth_obj)
+    tag_ids = snapshot.tag_ids(user_auth_obj)
+    return Q(creator__user_auth=user_auth_obj) \
+        | Q(public_visible=True) \
+        | Q(friend_visible=True, tag_visible=True, creator__in=friend_ids, tag__in=tag_ids) \
+        | Q(friend_visible=True, tag_visible=False, creator__in=friend_ids) \
+        | Q(friend_visible=False, tag_visible=True, tag__in=tag_ids)
+
+
+def accessible_posts(user_auth_obj, posts=Post.objects, snapshot=None):
+    """Filters the given posts down to those that the user has privilege to view.
+
+    Args:
+        user_auth_obj (UserAuth): the UserAuth instance representing the viewer
+        posts (QuerySet): the posts to filter, all posts by default
+        snapshot (SocialGraph): the social graph snapshot to read the friends and tags of the viewer from, a new one by default
+
+    Returns:
+        QuerySet: the posts accessible to the user
+    """
+    return posts.filter(accessible_posts_filter(user_auth_obj, snapshot))
 
 
 @login_required
@@ -510,8 +784,9 @@ def get_post(request, post_id):
     """
     try:
         post_object = Post.objects.get(id=post_id)
-        if has_access(request.user, post_object):
-            post_dict = parse_post_object(post_object, request.user)
+        snapshot = social_graph(request)
+        if has_access(request.user, post_object, snapshot):
+            post_dict = parse_post_object(post_object, request.user, snapshot)
             return JsonResponse(post_dict)
         else:
             return HttpResponseNotFound()
@@ -530,6 +805,7 @@ def get_post_pic(request, pic_id):
     """Return the picture with the given id.
     This view checks the user privilege to the post first before returning the image.
     If the user does not have privilege, or there is no picture with the given id, return not found.
+    The optional GET parameter size selects a scaled down derivative of the picture (see utils.media).
 
     Args:
         request (HttpRequest): the request made to this view
@@ -539,11 +815,8 @@ def get_post_pic(request, pic_id):
         FileResponse / HttpResponseNotFound: the picture, or response not found
     """
     try:
-        image_obj = PostImage.objects.get(id=pic_id)
-        if has_access(request.user, image_obj.post):
-            return FileResponse(image_obj.image)
-        else:
-            return HttpResponseNotFound()
+        image_obj = PostImage.objects.get(id=pic_id, post__in=accessible_posts(request.user, snapshot=social_graph(request)))
+        return image_file_response(request, image_obj.image)
     except ObjectDoesNotExist:
         return HttpResponseNotFound()
 
@@ -577,18 +850,15 @@ def get_profile_posts(request, username):
             tag = Tag.objects.get(name=request.GET["tag"])
             posts_queryset = posts_queryset.filter(tag=tag)
 
-        posts = list(map(
-            lambda post: parse_post_object(post, request.user),
-            filter(
-                lambda post: has_access(request.user, post),
-                list(posts_queryset.all())
-            )
-        ))
+        snapshot = social_graph(request)
+        posts = parse_post_objects(
+            accessible_posts(request.user, posts_queryset, snapshot).select_related(*POST_RELATED_FIELDS),
+            request.user,
+            snapshot
+        )
 
-        older_posts = user_log_obj.posts.filter(time_posted__lt=start_time).order_by("-time_posted")
-        next_last_timestamp = 0
-        if older_posts.exists():
-            next_last_timestamp = older_posts.first().time_posted
+        next_last_timestamp = user_log_obj.posts.filter(time_posted__lt=start_time).order_by("-time_posted") \
+            .values_list("time_posted", flat=True).first() or 0
 
         return JsonResponse({
             "posts": posts,
@@ -632,6 +902,8 @@ def get_home_feed(request):
             This is reused when user loads more recommended posts, to freeze the matching indices of the posts
             When requesting for recommended posts for the first time, initial_timestamp should be 0
             When trying to load more, use the previously returned initial_timestamp as the new initial_timestamp
+            The ranking of the posts is cached per initial_timestamp and filters for RANKED_FEED_CACHE_TIMEOUT seconds,
+            so loading more only takes the next page from the cached ranking
         
     Returns:
         JsonResponse containing post data, or HttpResponseBadRequest
@@ -648,15 +920,14 @@ def get_home_feed(request):
     """
     try:
         posts = Post.objects
+        snapshot = social_graph(request)
 
         # apply filters
         # posts = posts.exclude(creator=request.user.user_log)
         if request.GET["friend_filter"] == '1':
-            friend_list = request.user.user_log.friend_list.all()
-            posts = posts.filter(creator__in=friend_list)
+            posts = posts.filter(creator__in=snapshot.friend_ids(request.user))
         if request.GET["tag_filter"] == '1':
-            tag_list = request.user.user_profile.tagList.all()
-            posts = posts.filter(tag__in=tag_list)
+            posts = posts.filter(tag__in=snapshot.tag_ids(request.user))
 
         count = 0
         result = []
@@ -668,12 +939,12 @@ def get_home_feed(request):
             if start_timestamp != 0:
                 posts = posts.filter(time_posted__lt=start_timestamp)
             posts = posts.order_by('-time_posted')
-            for post_object in posts:
-                if has_access(request.user, post_object):
-                    result.append(parse_post_object(post_object, request.user))
-                    count += 1
-                    if count >= limit:
-                        break
+            result = parse_post_objects(
+                accessible_posts(request.user, posts, snapshot).select_related(*POST_RELATED_FIELDS)[:limit],
+                request.user,
+                snapshot
+            )
+            count = len(result)
             ret = {
                 "posts": result,
                 "stop_timestamp": 0.0
@@ -689,27 +960,27 @@ def get_home_feed(request):
             initial_timestamp = float(request.GET["initial_timestamp"])
             if initial_timestamp == 0:
                 initial_timestamp = datetime.now().timestamp()
-            posts = posts.filter(time_posted__gt=initial_timestamp - SECONDS_IN_A_DAY * RECOMMENDED_POSTS_DAY_RANGE).exclude(creator=request.user.user_log).all()
-            result = list(map(
-                lambda post: parse_post_object(post, request.user),
-                heapq.nlargest(
-                    limit,
-                    filter(
-                        lambda post: compute_matching_index_with_post(request.user, post, initial_timestamp) < start_index and has_access(request.user, post),
-                        posts
-                    ), 
-                    key=lambda post: compute_matching_index_with_post(request.user, post, initial_timestamp)
-                )
-            ))
+
+            # the ranking is frozen by initial_timestamp, so later pages are sliced from the cached ranking
+            cache_key = ranked_feed_cache_key(request.user, initial_timestamp, request.GET["friend_filter"], request.GET["tag_filter"])
+            ranking = cache.get(cache_key)
+            if ranking is None:
+                posts = posts.filter(time_posted__gt=initial_timestamp - SECONDS_IN_A_DAY * RECOMMENDED_POSTS_DAY_RANGE).exclude(creator=request.user.user_log)
+                ranking = rank_recommended_posts(request.user, accessible_posts(request.user, posts, snapshot), initial_timestamp)
+                cache.set(cache_key, ranking, RANKED_FEED_CACHE_TIMEOUT)
+            page = get_ranked_posts_page(ranking, start_index, limit)
+
+            # visibility is checked again, in case it has changed since the ranking was cached
+            posts_by_id = accessible_posts(request.user, Post.objects.filter(id__in=[post_id for post_id, _ in page]), snapshot) \
+                .select_related(*POST_RELATED_FIELDS).in_bulk()
+            result = parse_post_objects([posts_by_id[post_id] for post_id, _ in page if post_id in posts_by_id], request.user, snapshot)
             ret = {
                 "posts": result,
                 "stop_index": 0.0,
                 "initial_timestamp": initial_timestamp
             }
-            if len(result) > 0:
-                ret["stop_index"] = compute_matching_index_with_post(request.user,
-                                                                     Post.objects.get(id=result[-1]["id"]),
-                                                                     initial_timestamp)
+            if len(page) > 0:
+                ret["stop_index"] = page[-1][1]
 
         else:
             return HttpResponseBadRequest("sort method query string malformed")
@@ -18,6 +18,7 @@ import django
 django.setup()
 
 import message.routing
+import notification.routing
 
 django_asgi_app = get_asgi_application()
 
@@ -25,7 +26,7 @@ application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
         "websocket": AllowedHostsOriginValidator(
-            AuthMiddlewareStack(URLRouter(message.routing.websocket_urlpatterns))
+            AuthMiddlewareStack(URLRouter(message.routing.websocket_urlpatterns + notification.routing.websocket_urlpatterns))
         ),
     }
 )
\ No newline at end of file
@@ -167,6 +167,36 @@ UPLOAD_FILE_MAX_SIZE = 5242880 # 5 MB
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = 20971520 # 20 MB
 
+UPLOAD_STREAM_MAX_SIZE = 20971520 # 20 MB, checked while each uploaded file is parsed, after the ASGI handler has spooled the body
+
+# how media views deliver files after checking access, see utils.media.deliver_media
+MEDIA_DELIVERY_BACKEND = os.environ.get("MEDIA_DELIVERY_BACKEND", "stream")
+
+MEDIA_PRESIGNED_URL_EXPIRY = 300 # 5 minutes
+
+MEDIA_ACCEL_REDIRECT_PREFIX = "/protected-media/"
+
+FILE_UPLOAD_HANDLERS = [
+    "utils.upload.SizeLimitedUploadHandler",
+    "django.core.files.uploadhandler.MemoryFileUploadHandler",
+    "django.core.files.uploadhandler.TemporaryFileUploadHandler",
+]
+
+# how long the friends and tags of a user are shared across requests, see utils.social_graph; 0 disables sharing
+SOCIAL_GRAPH_CACHE_TIMEOUT = 30
+
+# whether text messages sent over WebSocket are broadcast first and written in batches, see message.write_behind
+MESSAGE_WRITE_BEHIND = os.environ.get("MESSAGE_WRITE_BEHIND") == "true"
+
+MESSAGE_WRITE_BEHIND_FLUSH_INTERVAL = 0.05 # seconds
+
+MESSAGE_WRITE_BEHIND_BATCH_SIZE = 100
+
+# users whose chat connections sent no heartbeat for this many seconds are offline, open connections send one every third of it, see message.presence
+PRESENCE_TIMEOUT = 60
+
+TYPING_EVENT_INTERVAL = 2 # seconds between typing events of a user in a chat
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -189,6 +219,26 @@ CHANNEL_LAYERS = {
     },
 }
 
+# cache, used for short-lived per-session data such as the ranking of recommended posts
+# in production, the Redis server is expected to evict keys in LRU order (maxmemory-policy allkeys-lru)
+if os.environ.get("DEBUG") == "false":
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ.get("REDIS_URL"),
+            "KEY_PREFIX": "cache",
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "OPTIONS": {
+                "MAX_ENTRIES": 1000,
+            },
+        },
+    }
+
 if os.environ.get('DEBUG') == 'false':
     AWS_S3_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
     AWS_S3_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_KEY')
@@ -199,3 +249,4 @@ if os.environ.get('DEBUG') == 'false':
     AWS_DEFAULT_ACL = None
     AWS_S3_VERIFY = True
     DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+    MEDIA_DELIVERY_BACKEND = os.environ.get('MEDIA_DELIVERY_BACKEND', 'presigned')
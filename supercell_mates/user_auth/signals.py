@@ -0,0 +1,14 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Tag, TagRequest
+from utils.tag import invalidate_tag_catalog
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=TagRequest)
+@receiver(post_delete, sender=TagRequest)
+def tag_changed(sender, **kwargs):
+    transaction.on_commit(invalidate_tag_catalog)
@@ -20,6 +20,8 @@ from .models import UserAuth, Tag, TagRequest, AdminApplication
 from user_profile.models import UserProfile
 from user_log.models import UserLog, FriendRequest
 from message.models import PrivateChat
+from utils.tag import all_tags, tag_name_taken
+from utils.upload import is_binary_upload, upload_params, read_binary_upload, reject_oversized_uploads
 
 
 
@@ -314,7 +316,7 @@ def change_password(request):
 
 
 def duplicate_tag_exists(tag_name):
-    """Determine if any current tag/tag request is the same as the tag name
+    """Determine if any current tag/tag request is the same as the tag name, using the tag catalog
 
     Args:
         tag_name (str): the tag name to check against db
@@ -323,19 +325,7 @@ def duplicate_tag_exists(tag_name):
         bool: whether there already exists a similar tag/tag request, True if it is so, False otherwise
     """
 
-    tag_name = tag_name.lower()
-    def same_tag(db_tag_name):
-        if len(db_tag_name) != len(tag_name):
-            return False
-        return db_tag_name.lower() == tag_name
-    
-    return any(list(map(
-        lambda tag: same_tag(tag.name),
-        list(Tag.objects.all())
-    ))) or any(list(map(
-        lambda tag: same_tag(tag.name),
-        list(TagRequest.objects.all())
-    )))
+    return tag_name_taken(tag_name)
 
 
 def add_tag_admin(request):
@@ -372,6 +362,7 @@ def add_tag_admin(request):
         return HttpResponseForbidden()
     
 
+@reject_oversized_uploads
 def new_tag_admin(request):
     if request.user.is_staff:
         if request.method == "POST":
@@ -437,20 +428,12 @@ def obtain_tag_requests(request):
 
 @login_required
 def obtain_tags(request):
-    result = list(map(
-        lambda tag: {
-            "name": tag.name,
-            "icon": reverse("user_profile:get_tag_icon", args=(tag.id,)),
-        },
-        list(Tag.objects.all())
-    ))
-    result.sort(key=lambda tag: tag["name"].lower())
-
     return JsonResponse({
-        "tags": result
+        "tags": all_tags()
     })
 
 
+@reject_oversized_uploads
 def change_tag_icon(request):
     if request.user.is_staff:
         if request.method == 'POST':
@@ -475,10 +458,16 @@ def change_tag_icon(request):
 
 @login_required
 @require_http_methods(["POST"])
+@reject_oversized_uploads
 def add_tag_request(request):
+    """Requests a new tag, optionally with an icon and attached to the profile of the requester once approved.
+    The parameters tag, description and attach are in the body form data, or in the query string if the icon is sent
+    as the whole request body with content type application/octet-stream, together with its file name as file_name.
+    """
     try:
-        tag_name = request.POST["tag"]
-        description = request.POST["description"]
+        params = upload_params(request)
+        tag_name = params["tag"]
+        description = params["description"]
         if len(tag_name) > 25:
             return HttpResponseBadRequest("tag name too long")
         if len(description) > 200:
@@ -487,7 +476,12 @@ def add_tag_request(request):
             return HttpResponse("tag already present/requested")
         
         has_img = False
-        if "img" in request.POST:
+        if is_binary_upload(request):
+            has_img = True
+            img = read_binary_upload(request, params["file_name"])
+            if img is None or not verify_image(img):
+                return HttpResponseBadRequest("not image")
+        elif "img" in request.POST:
             has_img = True
             img = list_to_image_and_verify_async(json.loads(request.POST["img"]), request.user.username)
             if img == "not image":
@@ -498,7 +492,7 @@ def add_tag_request(request):
             if not verify_image(img):
                 return HttpResponseBadRequest("not image")
     
-        if request.POST["attach"] == "true":
+        if params["attach"] == "true":
             if has_img:
                 tag_request = TagRequest(name=tag_name, image=img, description=description, requester=request.user.user_profile)
             else:
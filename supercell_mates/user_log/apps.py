@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class UserLogConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'user_log'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,55 @@
+# Generated by Django 4.0.4 on 2026-10-17 02:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+SEARCH_GRAM_LENGTH = 3
+
+
+def search_grams(value):
+    value = value.lower()
+    return set(value[i:i + SEARCH_GRAM_LENGTH] for i in range(len(value)))
+
+
+def build_search_index(apps, schema_editor):
+    UserAuth = apps.get_model('user_auth', 'UserAuth')
+    UserProfile = apps.get_model('user_profile', 'UserProfile')
+    UserSearchGram = apps.get_model('user_log', 'UserSearchGram')
+    UserSearchGram.objects.bulk_create((
+        UserSearchGram(user_id=user_id, field='username', gram=gram)
+        for (user_id, username) in UserAuth.objects.values_list('id', 'username').iterator()
+        for gram in search_grams(username)
+    ), batch_size=1000)
+    UserSearchGram.objects.bulk_create((
+        UserSearchGram(user_id=user_id, field='name', gram=gram)
+        for (user_id, name) in UserProfile.objects.values_list('user_auth_id', 'name').iterator()
+        for gram in search_grams(name)
+    ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('user_log', '0003_userlog_friend_visible_userlog_public_visible_and_more'),
+        ('user_profile', '0006_tagactivityrecord_tag_activity_profile_tag_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSearchGram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=10)),
+                ('gram', models.CharField(db_index=True, max_length=3)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_grams', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='usersearchgram',
+            index=models.Index(fields=['field', 'gram'], name='user_search_gram_field_idx'),
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
@@ -12,4 +12,37 @@ class UserLog(models.Model):
 
 class FriendRequest(models.Model):
     from_user = models.ForeignKey(UserLog, on_delete=models.CASCADE)
-    to_user = models.ForeignKey(UserLog, on_delete=models.CASCADE, related_name="friend_requests")
\ No newline at end of file
+    to_user = models.ForeignKey(UserLog, on_delete=models.CASCADE, related_name="friend_requests")
+
+
+"""User Search Index"""
+SEARCH_GRAM_LENGTH = 3
+
+
+class UserSearchGram(models.Model):
+    """Lowercase substrings of up to SEARCH_GRAM_LENGTH characters starting at each position of the username or name of a user,
+    kept in sync with the users by user_log.signals.
+    A user matches a search parameter if they have all of its grams (see search_param_grams), so that searches never scan all users.
+    """
+    user = models.ForeignKey('user_auth.UserAuth', on_delete=models.CASCADE, related_name="search_grams")
+    field = models.CharField(max_length=10) # either "username" or "name"
+    gram = models.CharField(max_length=SEARCH_GRAM_LENGTH, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["field", "gram"], name="user_search_gram_field_idx"),
+        ]
+
+
+def search_grams(value):
+    """Returns the set of grams to be indexed for the value of a field."""
+    value = value.lower()
+    return set(value[i:i + SEARCH_GRAM_LENGTH] for i in range(len(value)))
+
+
+def search_param_grams(search_param):
+    """Returns the set of full length grams of the search parameter, which is empty if the search parameter is shorter than SEARCH_GRAM_LENGTH.
+    Shorter search parameters instead match the grams that they are a prefix of.
+    """
+    search_param = search_param.lower()
+    return set(search_param[i:i + SEARCH_GRAM_LENGTH] for i in range(len(search_param) - SEARCH_GRAM_LENGTH + 1))
@@ -0,0 +1,77 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_init, post_save
+from django.dispatch import receiver
+
+from user_auth.models import UserAuth
+from user_profile.models import UserProfile
+from utils.social_graph import invalidate_social_graph
+from .models import UserLog, UserSearchGram, search_grams
+
+
+def index_search_grams(user_id, field, value):
+    """Replaces the search grams of a field of the user with those of its new value.
+
+    Args:
+        user_id (int): the id of the UserAuth instance of the user
+        field (str): the field of the user, either "username" or "name"
+        value (str): the new value of the field
+    """
+    UserSearchGram.objects.filter(user_id=user_id, field=field).delete()
+    UserSearchGram.objects.bulk_create([
+        UserSearchGram(user_id=user_id, field=field, gram=gram)
+        for gram in search_grams(value)
+    ])
+
+
+# the values of the fields when the instances are loaded, read from __dict__ so that deferred fields are not fetched
+@receiver(post_init, sender=UserAuth)
+def remember_username(sender, instance, **kwargs):
+    instance._indexed_username = instance.__dict__.get("username")
+
+
+@receiver(post_init, sender=UserProfile)
+def remember_name(sender, instance, **kwargs):
+    instance._indexed_name = instance.__dict__.get("name")
+
+
+@receiver(post_save, sender=UserAuth)
+def user_auth_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and "username" not in update_fields):
+        return
+    if created or instance.username != instance._indexed_username:
+        index_search_grams(instance.pk, "username", instance.username)
+        instance._indexed_username = instance.username
+
+
+@receiver(post_save, sender=UserProfile)
+def user_profile_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and "name" not in update_fields):
+        return
+    if created or instance.name != instance._indexed_name:
+        index_search_grams(instance.user_auth_id, "name", instance.name)
+        instance._indexed_name = instance.name
+
+
+@receiver(m2m_changed, sender=UserLog.friend_list.through)
+def friend_list_changed(sender, instance, action, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    # friendship is symmetrical, so the friends on both sides change
+    user_log_ids = {instance.pk} | set(pk_set or ())
+    if action == "pre_clear":
+        user_log_ids |= set(instance.friend_list.values_list("id", flat=True))
+    user_auth_ids = list(UserLog.objects.filter(id__in=user_log_ids).values_list("user_auth_id", flat=True))
+    transaction.on_commit(lambda: invalidate_social_graph(friend_user_auth_ids=user_auth_ids))
+
+
+@receiver(m2m_changed, sender=UserProfile.tagList.through)
+def tag_list_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if not reverse:
+        user_auth_ids = {instance.pk} # the primary key of UserProfile is the id of the UserAuth instance
+    elif action == "pre_clear":
+        user_auth_ids = set(instance.user_profiles.values_list("pk", flat=True))
+    else:
+        user_auth_ids = set(pk_set)
+    transaction.on_commit(lambda: invalidate_social_graph(tag_user_auth_ids=user_auth_ids))
@@ -1,3 +1,55 @@
 from django.test import TestCase
 
-# Create your tests here.
+from user_auth.models import UserAuth, Tag
+from user_profile.models import UserProfile
+from user_profile.views import attach_tag_to_user
+from .models import UserLog
+
+
+def create_user(username, name, tags=()):
+    user = UserAuth.objects.create_user(username=username, password="password")
+    user_profile_obj = UserProfile.objects.create(name=name, user_auth=user)
+    UserLog.objects.create(user_auth=user, user_profile=user_profile_obj)
+    for tag in tags:
+        attach_tag_to_user(user_profile_obj, tag)
+    return user
+
+
+class SearchPagingTest(TestCase):
+    """Following next_offset must return every matching user once, sorted by name."""
+
+    def setUp(self):
+        self.tag = Tag.objects.create(name="tag")
+        self.searcher = create_user("searcher", "Searcher")
+        # "alice" is in both the usernames and the names of the first users, and only in the name of the last one
+        self.users = [create_user(f"alice{i}", f"Alice {i:02}", [self.tag] if i % 2 else []) for i in range(11)]
+        self.users.append(create_user("zed", "Zed Alice", [self.tag]))
+        create_user("bob", "Bob", [self.tag])
+        self.client.force_login(self.searcher)
+
+    def search_all(self, url, params):
+        usernames = []
+        offset = 0
+        while offset is not None:
+            response = self.client.get(url, {**params, "offset": offset, "limit": 4}, HTTP_HOST="localhost")
+            self.assertEqual(response.status_code, 200, response.content)
+            content = response.json()
+            self.assertLessEqual(len(content["users"]), 4)
+            usernames += [user["username"] for user in content["users"]]
+            offset = content["next_offset"]
+        return usernames
+
+    def test_search(self):
+        self.assertEqual(self.search_all("/user/search", {"username": "alice"}), [user.username for user in self.users])
+
+    def test_search_username_with_tags(self):
+        self.assertEqual(
+            self.search_all("/user/search_username", {"username": "ALICE", "tags": [self.tag.name]}),
+            [user.username for user in self.users[1:11:2]]
+        )
+
+    def test_invalid_parameters(self):
+        for params in ({"offset": -1}, {"limit": 0}, {"limit": 201}, {"offset": "next"}):
+            with self.subTest(params=params):
+                response = self.client.get("/user/search", {"username": "alice", **params}, HTTP_HOST="localhost")
+                self.assertEqual(response.status_code, 400)
@@ -19,5 +19,6 @@ urlpatterns = [
     path('search_friend', views.search_friend, name='search_friend'),
     path('search_friend_username', views.search_friend_username, name='search_friend_username'),
     path('delete_friend', views.delete_friend, name="delete_friend"),
+    path('online_friends', views.online_friends, name="online_friends"),
     path('get_badges', views.get_badges, name='get_badges'),
 ]
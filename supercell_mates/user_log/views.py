@@ -5,22 +5,38 @@ from django.utils.datastructures import MultiValueDictKeyError
 from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, HttpResponseNotFound
 from django.views.decorators.http import require_http_methods
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q, Count
+from django.db.models.functions import Lower
 from datetime import datetime
-from user_profile.views import layout_context, get_tag_activity_record, compute_tag_activity_final_score
+from asgiref.sync import async_to_sync
+import numpy as np
+from user_profile.views import layout_context, compute_tag_activity_final_scores
+from user_profile.models import TagActivityRecord
 
 from user_auth.models import UserAuth, Tag
-from .models import FriendRequest
+from .models import FriendRequest, UserSearchGram, search_param_grams
 from message.models import PrivateChat
+from message.presence import online_user_ids
+from message.relay import push_chats_changed
+from notification.push import push_friend_request, push_friend_accepted
 from notification.models import FriendNotification
 from utils.user import can_view_profile
+from utils.social_graph import SocialGraph, social_graph
+from utils.media import versioned_media_url
+from utils.realtime import group_send_on_commit
 
 
-def view_profile_context(user_auth_obj, request_user):
+SEARCH_PAGE_LIMIT = 50 # default number of users returned in one search request
+SEARCH_PAGE_MAX_LIMIT = 200
+
+
+def view_profile_context(user_auth_obj, request_user, snapshot=None):
     """Returns the context to be used when rendering template to view another user's profile
 
     Args:
         user_auth_obj (UserAuth): the UserAuth instance of the user whose info is to be rendered on the template
         request_user (UserAuth): the UserAuth instance of the user that made the request for this template
+        snapshot (SocialGraph): the social graph snapshot to read friends and tags from, a new one by default
 
     Returns:
         dict: the context to be used for template rendering of another user's profile page
@@ -43,12 +59,13 @@ def view_profile_context(user_auth_obj, request_user):
         }),
         list(user_auth_obj.user_profile.tagList.all())
     ))
+    snapshot = snapshot or SocialGraph()
     result = {
         "tags": tags,
         "my_profile": False,
-        "is_friend": user_auth_obj.user_log in request_user.user_log.friend_list.all(),
+        "is_friend": user_auth_obj.user_log.id in snapshot.friend_ids(request_user),
         "is_friend_request_sent": FriendRequest.objects.filter(to_user=request_user.user_log, from_user=user_auth_obj.user_log).exists(),
-        "matching_index": round(compute_matching_index(user_auth_obj, request_user))
+        "matching_index": round(compute_matching_index(user_auth_obj, request_user, snapshot))
     }
     result.update(layout_context(user_auth_obj))
     return result
@@ -70,8 +87,8 @@ def view_profile(request, username):
     try:
         if request.user.username == username:
             return redirect(reverse("user_profile:index"))
-        elif can_view_profile(request.user, username):
-            return render(request, "user_log/view_profile.html", view_profile_context(UserAuth.objects.get(username=username), request.user))
+        elif can_view_profile(request.user, username, social_graph(request)):
+            return render(request, "user_log/view_profile.html", view_profile_context(UserAuth.objects.get(username=username), request.user, social_graph(request)))
         else:
             return HttpResponseNotFound()
     except ObjectDoesNotExist:
@@ -93,8 +110,8 @@ def view_profile_async(request, username):
     try:
         if request.user.username == username:
             return redirect(reverse("user_profile:index_async"))
-        if can_view_profile(request.user, username):
-            return JsonResponse(view_profile_context(UserAuth.objects.get(username=username), request.user))
+        if can_view_profile(request.user, username, social_graph(request)):
+            return JsonResponse(view_profile_context(UserAuth.objects.get(username=username), request.user, social_graph(request)))
         else:
             return HttpResponseNotFound()
     except ObjectDoesNotExist:
@@ -138,7 +155,7 @@ def profile_privilege(request):
     try:
         username = request.GET["username"]
         return JsonResponse({
-            "can_view": request.user.username == username or can_view_profile(request.user, username),
+            "can_view": request.user.username == username or can_view_profile(request.user, username, social_graph(request)),
         })
     
     except MultiValueDictKeyError:
@@ -166,11 +183,12 @@ def add_friend_request(request):
         if username == request.user.username:
             return HttpResponseBadRequest("cannot send friend request to yourself")
         user_log_obj = UserAuth.objects.get(username=username).user_log
-        is_friend = user_log_obj in request.user.user_log.friend_list.all()
+        is_friend = user_log_obj.id in SocialGraph(use_cache=False).friend_ids(request.user)
         friend_request_sent = FriendRequest.objects.filter(from_user=request.user.user_log, to_user=user_log_obj).exists() or FriendRequest.objects.filter(to_user=request.user.user_log, from_user=user_log_obj).exists()
         if not is_friend and not friend_request_sent:
             friend_request = FriendRequest(from_user=request.user.user_log, to_user=user_log_obj)
             friend_request.save()
+            push_friend_request(request.user, user_log_obj.user_auth)
             return HttpResponse("ok")
         elif friend_request_sent:
             return HttpResponse("ok")
@@ -228,6 +246,22 @@ def view_friends_async(request):
     return JsonResponse(friends, safe=False)
 
 
+@login_required
+def online_friends(request):
+    """Returns the usernames of the friends of the request user who are online, see message.presence.
+    The presence of all the friends is looked up with one Redis command.
+
+    Args:
+        request (HttpRequest): the request made to this view
+
+    Returns:
+        JsonResponse: the list of usernames of the online friends, sorted
+    """
+    friends = dict(UserAuth.objects.filter(user_log__in=social_graph(request).friend_ids(request.user)).values_list("id", "username"))
+    online_ids = async_to_sync(online_user_ids)(list(friends.keys()))
+    return JsonResponse(sorted(friends[user_id] for user_id in online_ids), safe=False)
+
+
 def get_friend_requests_list(user):
     """Returns the friend requests to the current user (request user).
 
@@ -301,12 +335,14 @@ def add_friend(request):
                 request.user.user_log.friend_list.add(user_log_obj)
                 friend_notification = FriendNotification(from_user=request.user.user_log, to_user=user_log_obj)
                 friend_notification.save()
+                push_friend_accepted(request.user, user_log_obj.user_auth)
                 if not request.user.private_chats.filter(users=request.user).filter(users=user_log_obj.user_auth).exists():
                     new_chat = PrivateChat(timestamp=datetime.now().timestamp())
                     new_chat.save()
                     new_chat.users.add(request.user)
                     new_chat.users.add(user_log_obj.user_auth)
                     new_chat.save()
+                    push_chats_changed([request.user.id, user_log_obj.user_auth_id])
             return HttpResponse("ok")
         else:
             return HttpResponseBadRequest("the user with provided username did not send a friend request to you")
@@ -316,54 +352,92 @@ def add_friend(request):
         return HttpResponseBadRequest("user with the requested username does not exist")
 
 
-def find_users(search_param, my_username, by_username_only, tags):
-    """Return the list of users with the search parameter excluding the user with my_username.
-    Match is based on whether the username or name of each user contains the search parameter.
+def search_gram_matches(search_param, field):
+    """Returns a queryset of the ids of users whose search grams of the field match the search parameter.
+    Every user whose field contains the search parameter is matched, but for search parameters of at least SEARCH_GRAM_LENGTH
+    characters, some users whose field does not contain it may also be matched, so the results must be checked against the field.
+
+    Args:
+        search_param (str): the search parameter
+        field (str): the field of the users to match, either "username" or "name"
+    
+    Returns:
+        QuerySet: the ids of the matched users
+    """
+    grams = search_param_grams(search_param)
+    field_grams = UserSearchGram.objects.filter(field=field)
+    if not grams:
+        return field_grams.filter(gram__startswith=search_param.lower()).values("user_id")
+    return field_grams.filter(gram__in=grams).values("user_id") \
+        .annotate(matched_grams=Count("gram", distinct=True)).filter(matched_grams=len(grams)).values("user_id")
+
+
+def find_users(search_param, my_username, by_username_only, tags, offset=0, limit=SEARCH_PAGE_LIMIT):
+    """Return a page of the users with the search parameter excluding the user with my_username, sorted by name.
+    Match is based on whether the username or name of each user contains the search parameter, case-insensitively.
+    Users are looked up from the search index with one query, with the tag filter applied in the same query.
 
     Args:
         search_param (str): the search parameter
         my_username (str): the username of the user to be excluded from search results
         by_username_only (bool): if True, users will only be matched if their username contains the search parameter
         tags (List<Tag>): filter in users if they have one of the listed tags, empty list if no filter
+        offset (int): the number of matching users to skip
+        limit (int): the maximum number of users to return
     
     Returns:
-        list(dict): a list of users that matches the search conditions, each represented by a dictionary.
+        tuple(list(dict), int): a list of users that matches the search conditions, each represented by a dictionary,
+        and the offset of the next page, or None if there are no more matching users.
         Each dictionary representing a user has the following fields:
             name: the name of the user
             username: the username of the user
             profile_pic_url: the URL to the profile picture of the user
             profile_link: the URL to the profile page of the user
     """
-    search_param = search_param.lower()
-    my_username = my_username.lower()
+    matches = Q(id__in=search_gram_matches(search_param, "username"), username__icontains=search_param)
+    if not by_username_only:
+        matches |= Q(id__in=search_gram_matches(search_param, "name"), user_profile__name__icontains=search_param)
 
-    my_user_auth = UserAuth.objects.get(username=my_username)
-    result = filter(
-        lambda user: (search_param in user.username.lower() or (search_param in user.user_profile.name.lower() if not by_username_only else False)) \
-            and user.username != my_username,
-        list(UserAuth.objects.all())
+    users = UserAuth.objects.filter(matches).exclude(username__iexact=my_username)
+    if tags:
+        users = users.filter(id__in=Tag.user_profiles.through.objects.filter(tag__in=tags).values("userprofile_id"))
+    users = list(
+        users.select_related("user_profile").order_by(Lower("user_profile__name"), "username")[offset:offset + limit + 1]
     )
 
-    if tags:
-        result = filter(
-            lambda user: any(filter(
-                lambda tag: user.user_profile.tagList.all().contains(tag),
-                tags,
-            )),
-            result,
-        )
-    
+    next_offset = offset + limit if len(users) > limit else None
     result = list(map(
         lambda user: ({
             "name": user.user_profile.name,
             "username": user.username,
-            "profile_pic_url": reverse("user_profile:get_profile_pic", args=(user.username,)),
+            "profile_pic_url": versioned_media_url(
+                reverse("user_profile:get_profile_pic", args=(user.username,)), user.user_profile.profile_pic.name
+            ),
             "profile_link": reverse("user_log:view_profile", args=(user.username,)),
         }),
-        result,
+        users[:limit],
     ))
-    result.sort(key=lambda user: user["name"].lower())
-    return result
+    return result, next_offset
+
+
+def offset_and_limit(request):
+    """Return the offset and limit values in the parameter, which default to 0 and SEARCH_PAGE_LIMIT.
+    If there is an error, return a string.
+
+    Args:
+        request (HttpRequest): the request to extract GET parameters from
+    
+    Returns:
+        tuple/str: offset and limit from the request GET parameters, or a string if there is an error
+    """
+    try:
+        offset = int(request.GET.get("offset", 0))
+        limit = int(request.GET.get("limit", SEARCH_PAGE_LIMIT))
+    except ValueError:
+        return "offset and limit GET parameters must be integers"
+    if offset < 0 or limit <= 0 or limit > SEARCH_PAGE_MAX_LIMIT:
+        return f"offset must not be negative and limit must be between 1 and {SEARCH_PAGE_MAX_LIMIT}"
+    return (offset, limit)
 
 
 @login_required
@@ -372,9 +446,12 @@ def search(request):
     GET parameters:
         username: the search parameter
         tags: the list of tags, must be in list form. If not provided, assume that no filter by tag
+        offset (optional): the number of matching users to skip, 0 by default
+        limit (optional): the maximum number of users to return, SEARCH_PAGE_LIMIT by default
     The search returns users whose usernames or names contain the search parameter.
     The returned json contains the following fields:
         users: the list of users returned by find_users method above, with excluded user being the current user
+        next_offset: the offset of the next page of users, null if there are no more users
     
     Args:
         request (HttpRequest): the request made to this view
@@ -399,9 +476,15 @@ def search(request):
                 return HttpResponseBadRequest("tag object does not exist")
             tag_objects.append(Tag.objects.get(name=tag))
 
-        users = find_users(search_param, request.user.username, False, tag_objects)
+        get_params = offset_and_limit(request)
+        if type(get_params) == str:
+            return HttpResponseBadRequest(get_params)
+        offset, limit = get_params
+
+        users, next_offset = find_users(search_param, request.user.username, False, tag_objects, offset, limit)
         return JsonResponse({
-            "users": users
+            "users": users,
+            "next_offset": next_offset
         })
     except MultiValueDictKeyError:
         return HttpResponseBadRequest("no username (GET) parameter found in the request")
@@ -432,9 +515,15 @@ def search_username(request):
                 return HttpResponseBadRequest("tag object does not exist")
             tag_objects.append(Tag.objects.get(name=tag))
         
-        users = find_users(search_param, request.user.username, True, tag_objects)
+        get_params = offset_and_limit(request)
+        if type(get_params) == str:
+            return HttpResponseBadRequest(get_params)
+        offset, limit = get_params
+
+        users, next_offset = find_users(search_param, request.user.username, True, tag_objects, offset, limit)
         return JsonResponse({
-            "users": users
+            "users": users,
+            "next_offset": next_offset
         })
     except MultiValueDictKeyError:
         return HttpResponseBadRequest("no username (GET) parameter found in the request")
@@ -545,8 +634,11 @@ def delete_friend(request):
     try:
         username = request.POST["username"]
         user_log_obj = UserAuth.objects.get(username=username).user_log
-        if user_log_obj in list(request.user.user_log.friend_list.all()):
+        if user_log_obj.id in SocialGraph(use_cache=False).friend_ids(request.user):
             request.user.user_log.friend_list.remove(user_log_obj)
+            # the private chats between the two users stay, but neither of them can send messages in them anymore
+            for chat_id in PrivateChat.objects.filter(users=request.user).filter(users=user_log_obj.user_auth_id).values_list("id", flat=True):
+                group_send_on_commit(chat_id, {"type": "access_changed", "usernames": [request.user.username, username]})
             return HttpResponse("friend deleted")
         else:
             return HttpResponseBadRequest("user with username is not in your friend list")
@@ -559,13 +651,14 @@ def delete_friend(request):
 COMMON_TAG_PROPORTION_EXPONENT = 0.5
 
 
-def compute_matching_index(user1, user2):
+def compute_matching_index(user1, user2, snapshot=None):
     """Computes the matching index between two users.
     Currently, the matching index ranges from 0 (no common tags) to 5.0 (have same set of tags and both active)
 
     Args:
         user1: user_auth object of the first user
         user2: user_auth object of the second user
+        snapshot: the social graph snapshot to read the tags of the users from, a new one by default
 
     Returns: the matching index of the two users, computed with formula:
         common_tag_proportion = number of common tags / number of tags of the user with fewer tags
@@ -573,24 +666,73 @@ def compute_matching_index(user1, user2):
         matching_index = common_tag_proportion ** COMMON_TAG_PROPORTION_EXPONENT * final_scores_average
 
     """
-    if user1 == user2:
-        # In case of bugs / malformed requests
-        return 0
-    common_tag_list = user1.user_profile.tagList.all() & user2.user_profile.tagList.all()
-    if len(common_tag_list) == 0:
-        return 0
-    smaller_tag_list_length = min(user1.user_profile.tagList.count(), user2.user_profile.tagList.count())
-    common_tag_proportion = len(common_tag_list) / smaller_tag_list_length
+    return compute_matching_indices(user1, [user2], snapshot)[user2.id]
+
 
-    final_scores_sum = 0
-    for tag in common_tag_list:
-        final_scores_sum += compute_tag_activity_final_score(get_tag_activity_record(user1, tag))
-        final_scores_sum += compute_tag_activity_final_score(get_tag_activity_record(user2, tag))
-    final_scores_average = final_scores_sum / (2 * len(common_tag_list))
+def compute_matching_indices(user, candidates, snapshot=None, timestamp=None):
+    """Computes the matching index between the user and each of the candidate users, with the formula of compute_matching_index.
+    The tags of all the users are read from the snapshot, and the tag activity records of the tags of the user are loaded in one query.
+    The final scores of the records are computed together, without updating any record.
 
-    matching_index = common_tag_proportion ** COMMON_TAG_PROPORTION_EXPONENT * final_scores_average
+    Args:
+        user (UserAuth): the user to compute the matching indices for
+        candidates (list(UserAuth)): the users to match with the user
+        snapshot (SocialGraph): the social graph snapshot to read the tags of the users from, a new one by default
+        timestamp (float): the epoch time at which the final scores are computed, the current time by default
 
-    return matching_index
+    Returns:
+        dict: the matching index of each candidate, keyed by the id of the UserAuth instance of the candidate.
+        A record missing for a common tag counts as a final score of 0.
+    """
+    snapshot = snapshot or SocialGraph()
+    if timestamp is None:
+        timestamp = datetime.now().timestamp()
+    candidates = {candidate.id: candidate for candidate in candidates}
+    # In case of bugs / malformed requests
+    result = {user.id: 0} if candidates.pop(user.id, None) is not None else {}
+    candidates = list(candidates.values())
+    candidate_ids = [candidate.id for candidate in candidates]
+    snapshot.load_tag_ids([user.id] + candidate_ids)
+    my_tag_ids = list(snapshot.tag_ids(user))
+    if not candidate_ids or not my_tag_ids:
+        result.update({candidate_id: 0 for candidate_id in candidate_ids})
+        return result
+
+    # rows are the user followed by the candidates, columns are the tags of the user
+    row_of_user = {user_id: row for row, user_id in enumerate([user.id] + candidate_ids)}
+    column_of_tag = {tag_id: column for column, tag_id in enumerate(my_tag_ids)}
+    has_tag = np.zeros((len(row_of_user), len(my_tag_ids)), dtype=bool)
+    tag_counts = np.zeros(len(row_of_user))
+    for row, row_user in enumerate([user] + candidates):
+        tag_ids = snapshot.tag_ids(row_user)
+        tag_counts[row] = len(tag_ids)
+        has_tag[row, [column_of_tag[tag_id] for tag_id in tag_ids if tag_id in column_of_tag]] = True
+
+    records = np.array(TagActivityRecord.objects.filter(
+        user_profile_id__in=row_of_user.keys(),
+        tag_id__in=my_tag_ids,
+    ).values_list("user_profile_id", "tag_id", "activity_score", "last_activity_timestamp"), dtype=float).reshape(-1, 4)
+    final_scores = np.zeros(has_tag.shape)
+    final_scores[
+        [row_of_user[int(user_id)] for user_id in records[:, 0]],
+        [column_of_tag[int(tag_id)] for tag_id in records[:, 1]],
+    ] = compute_tag_activity_final_scores(records[:, 2], records[:, 3], timestamp)
+
+    # a column is counted for a candidate only if both the user and the candidate have the tag
+    common = has_tag[1:]
+    common_tag_counts = common.sum(axis=1)
+    final_scores_sums = np.where(common, final_scores[1:] + final_scores[0], 0).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        common_tag_proportions = common_tag_counts / np.minimum(tag_counts[1:], tag_counts[0])
+        final_scores_averages = final_scores_sums / (2 * common_tag_counts)
+        matching_indices = np.where(
+            common_tag_counts > 0,
+            common_tag_proportions ** COMMON_TAG_PROPORTION_EXPONENT * final_scores_averages,
+            0,
+        )
+
+    result.update(zip(candidate_ids, matching_indices.tolist()))
+    return result
 
 
 @login_required
@@ -601,7 +743,7 @@ def get_badges(request):
     """
     try:
         username = request.GET['username']
-        if request.user.username != username and not can_view_profile(request.user, username):
+        if request.user.username != username and not can_view_profile(request.user, username, social_graph(request)):
             return HttpResponseBadRequest("no viewing privilege")
         
         target = UserAuth.objects.get(username=username)
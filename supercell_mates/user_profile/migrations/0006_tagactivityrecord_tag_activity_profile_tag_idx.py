@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-17 02:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_profile', '0005_userprofile_readme_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tagactivityrecord',
+            index=models.Index(fields=['user_profile', 'tag'], name='tag_activity_profile_tag_idx'),
+        ),
+    ]
@@ -19,3 +19,8 @@ class TagActivityRecord(models.Model):
     tag = models.ForeignKey("user_auth.Tag", on_delete=models.CASCADE, related_name="tag_activity_records")
     activity_score = models.FloatField(default=2)
     last_activity_timestamp = models.FloatField(default=datetime.now().timestamp())
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user_profile", "tag"], name="tag_activity_profile_tag_idx"),
+        ]
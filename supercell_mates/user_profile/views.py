@@ -1,7 +1,6 @@
 from django.shortcuts import render, redirect
 from django.urls import reverse
-from django.http import JsonResponse, HttpResponseBadRequest, HttpResponse, FileResponse, HttpResponseNotFound
-from django.http.response import FileResponse
+from django.http import JsonResponse, HttpResponseBadRequest, HttpResponse, HttpResponseNotFound
 from django.utils.datastructures import MultiValueDictKeyError
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.decorators import login_required
@@ -17,10 +16,15 @@ from django.conf import settings
 from PIL import Image
 import json
 from datetime import datetime
+import numpy as np
 
 from user_auth.models import Tag, UserAuth
 from user_log.models import FriendRequest
 from utils.user import can_view_profile
+from utils.social_graph import social_graph
+from utils.tag import search_tag_catalog
+from utils.upload import is_binary_upload, read_binary_upload, reject_oversized_uploads
+from utils.media import image_file_response
 
 
 def layout_context(user_auth_obj):
@@ -234,6 +238,7 @@ def obtain_tags(request):
 def find_tags(search_param, user_profile_obj):
     """Return the list of tags that match the search parameter.
     The search returns the tags that contains the search parameter, excluding those that the current user already has.
+    Tags are searched in the tag catalog, so only the tags of the current user are read from the database.
     Each item in the list is a dictionary with the following fields:
         name: the name of the tags
         icon: the URL to the icon of the tag
@@ -246,21 +251,8 @@ def find_tags(search_param, user_profile_obj):
         list(dict): the list of tags that match the search parameter
     """
 
-    user_tags = set(user_profile_obj.tagList.all())
-    search_param = search_param.lower()
-
-    result = list(map(
-        lambda tag: ({
-            "name": tag.name,
-            "icon": reverse('user_profile:get_tag_icon', args=(tag.id,)),
-        }),
-        filter(
-            lambda tag: search_param in tag.name.lower() and tag not in user_tags,
-            list(Tag.objects.all())
-        )
-    ))
-    result.sort(key=lambda tag: tag["name"].lower())
-    return result
+    user_tag_ids = set(user_profile_obj.tagList.values_list("id", flat=True))
+    return search_tag_catalog(search_param, user_tag_ids)
 
 
 @login_required
@@ -323,8 +315,10 @@ def verify_image(img):
 
 
 def list_to_image_and_verify_async(uint8list, name):
-    img_bytearray = bytearray(uint8list)
-    img = ImageFile(io.BytesIO(img_bytearray), name=name)
+    """Compatibility path for clients that send images as JSON lists of bytes, prefer file or binary uploads (see utils.upload)."""
+    if len(uint8list) > settings.UPLOAD_FILE_MAX_SIZE:
+        return "not image"
+    img = ImageFile(io.BytesIO(bytes(uint8list)), name=name)
     try:
         pil_img = Image.open(img)
         pil_img.verify()
@@ -335,11 +329,13 @@ def list_to_image_and_verify_async(uint8list, name):
 
 @login_required
 @require_http_methods(["POST"])
+@reject_oversized_uploads
 def set_profile_image(request):
     """Set profile image for the current user and return the feedback of the result.
     The request method must be post, and the request body must contain a file.
     The file must be sent either in byte array representation of the image, under request.POST,
-    or as file data in request.FILES.
+    or as file data in request.FILES, or as the whole request body with content type application/octet-stream,
+    in which case the query string must contain the name of the file as file_name.
     If there is an error raised during image processing, an HttpResponse is returned with status code 405 and explanation for error.
 
     Args:
@@ -350,7 +346,12 @@ def set_profile_image(request):
     """
     try:
         user_profile_obj = request.user.user_profile
-        if "img" in request.POST:
+        if is_binary_upload(request):
+            img = read_binary_upload(request, request.GET["file_name"])
+            if img is None or not verify_image(img):
+                return HttpResponseBadRequest("not image")
+            user_profile_obj.profile_pic = img
+        elif "img" in request.POST:
             img = list_to_image_and_verify_async(json.loads(request.POST["img"]), request.user.username)
             if img == "not image":
                 return HttpResponseBadRequest("not image")
@@ -362,6 +363,8 @@ def set_profile_image(request):
             if not verify_image(img):
                 return HttpResponseBadRequest("not image")
             user_profile_obj.profile_pic = img
+        else:
+            return HttpResponseBadRequest("request body is missing image (file)")
         user_profile_obj.save()
         return HttpResponse("success")
     except MultiValueDictKeyError:
@@ -373,6 +376,7 @@ def get_profile_pic(request, username):
     """Obtain the image file of the profile picture of the indicated username.
     Username must be indicated clearly in the URL path.
     The default profile picture will be returned if the user with given username has not uploaded a profile picture.
+    The optional GET parameter size selects a scaled down derivative of the picture (see utils.media).
 
     Args:
         request (HttpRequest): the request made to this view
@@ -388,13 +392,14 @@ def get_profile_pic(request, username):
         if not profile_pic:
             return redirect('/static/media/default_profile_pic.jpg')
         else:
-            return FileResponse(profile_pic)
+            return image_file_response(request, profile_pic)
 
 
 @login_required
 def get_tag_icon(request, tag_id):
     """Obtain the icon of the tag.
     The tag name must be spelled out clearly in the URL.
+    The optional GET parameter size selects a scaled down derivative of the icon (see utils.media).
 
     Args:
         request (HttpRequest): the requesst made to this view
@@ -411,7 +416,7 @@ def get_tag_icon(request, tag_id):
         if not icon:
             return redirect('/static/media/default-tag-icon.png')
         else:
-            return FileResponse(icon)
+            return image_file_response(request, icon)
 
 
 @login_required
@@ -558,6 +563,25 @@ def compute_tag_activity_final_score(record, update=True, timestamp=None):
     return final_score
 
 
+def compute_tag_activity_final_scores(activity_scores, last_activity_timestamps, timestamp):
+    """Computes the final scores of many tag activity records at once, without updating any record.
+    Each final score is the same as that of compute_tag_activity_final_score with the given timestamp.
+
+    Args:
+        activity_scores (numpy.ndarray): the activity scores of the records
+        last_activity_timestamps (numpy.ndarray): the last activity timestamps of the records
+        timestamp (float): the epoch time at which the scores are computed
+
+    Returns:
+        numpy.ndarray: the final scores of the records, in the same order
+    """
+    days_since_last_activity = (timestamp - last_activity_timestamps) / SECONDS_IN_A_DAY
+    decrease = DECREASE_COEFFICIENT * np.clip(days_since_last_activity, 0, None) ** DECREASE_EXPONENT
+    final_scores = np.clip(activity_scores - decrease, MINIMUM_ACTIVITY_SCORE, MAXIMUM_ACTIVITY_SCORE)
+    out_of_range = (days_since_last_activity > DAYS_TO_REACH_LOWEST) | (days_since_last_activity < 0)
+    return np.where(out_of_range, MINIMUM_ACTIVITY_SCORE, final_scores)
+
+
 @login_required
 def achievements(request, username):
     """Render achievement page.
@@ -569,7 +593,7 @@ def achievements(request, username):
     context = layout_context(user_auth_obj)
     context.update({
         "my_profile": request.user.username == username,
-        "is_friend": user_auth_obj.user_log in request.user.user_log.friend_list.all(),
+        "is_friend": user_auth_obj.user_log.id in social_graph(request).friend_ids(request.user),
         "is_friend_request_sent": FriendRequest.objects.filter(to_user=request.user.user_log, from_user=user_auth_obj.user_log).exists()
     })
     return render(request, 'user_profile/achievements.html', context)
@@ -577,7 +601,7 @@ def achievements(request, username):
 
 @login_required
 def readme(request, username):
-    if request.user.username != username and not can_view_profile(request.user, username):
+    if request.user.username != username and not can_view_profile(request.user, username, social_graph(request)):
         return HttpResponseBadRequest("unauthorised")
     
     return JsonResponse({
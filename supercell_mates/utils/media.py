@@ -0,0 +1,157 @@
+import io
+import hashlib
+import mimetypes
+from urllib.parse import quote
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.http import HttpResponse, FileResponse, HttpResponseBadRequest, HttpResponseRedirect
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from PIL import Image, ImageOps, features
+
+
+# sizes of the image derivatives that can be requested with the size GET parameter, as the maximum width and height in pixels
+IMAGE_DERIVATIVE_SIZES = {
+    "thumb": 96,
+    "small": 320,
+    "medium": 800,
+}
+
+# Pillow format and file extension of the image derivatives, WebP if Pillow was built with it
+IMAGE_DERIVATIVE_FORMAT, IMAGE_DERIVATIVE_EXTENSION = ("WEBP", "webp") if features.check("webp") else ("JPEG", "jpg")
+IMAGE_DERIVATIVE_QUALITY = 80
+
+# how long browsers may keep images requested with their current version (see versioned_media_url)
+VERSIONED_MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def media_version(name):
+    """Returns the version of a stored file, derived from its name, which the storage never reuses for other content."""
+    return hashlib.sha1(name.encode()).hexdigest()[:12]
+
+
+def versioned_media_url(url, file_name):
+    """Returns the URL of a media view with the version of the image it serves, so that the response can be cached
+    until the image changes. The URL is returned as is if there is no image (and the view redirects to a default image).
+
+    Args:
+        url (str): the URL of the media view
+        file_name (str): the name of the image served by the view in storage, empty or None if there is no image
+    
+    Returns:
+        str: the URL with the v GET parameter
+    """
+    if not file_name:
+        return url
+    return f"{url}?v={media_version(file_name)}"
+
+
+def image_derivative_name(name, size):
+    """Returns the name of the derivative of the given size of the image with the name, which is next to the image in storage.
+    The whole name of the image is kept, extension included, so that images that only differ by their extension
+    (e.g. photo.jpg and photo.png) never share derivatives.
+    """
+    return f"{name}.{size}.{IMAGE_DERIVATIVE_EXTENSION}"
+
+
+def render_image_derivative(image_file, max_dimension):
+    """Returns the content of the image scaled down to fit in a square of the given dimension,
+    or None if the file cannot be read as an image by Pillow, or is so large that decoding it could be a decompression bomb.
+    """
+    try:
+        image_file.open("rb")
+        with Image.open(image_file) as img:
+            img.draft("RGB", (max_dimension, max_dimension)) # only decodes the needed resolution of JPEG images
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((max_dimension, max_dimension))
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            mode = "RGBA" if has_alpha and IMAGE_DERIVATIVE_FORMAT == "WEBP" else "RGB"
+            if img.mode != mode:
+                img = img.convert(mode)
+            buffer = io.BytesIO()
+            img.save(buffer, IMAGE_DERIVATIVE_FORMAT, quality=IMAGE_DERIVATIVE_QUALITY)
+    except (IOError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return None
+    finally:
+        image_file.close()
+    return ContentFile(buffer.getvalue())
+
+
+def get_image_derivative(image_file, size):
+    """Returns the name in storage of the derivative of the given size of the image, generating and storing it on first use.
+    The name of the image itself is returned if it cannot be read as an image.
+
+    Args:
+        image_file (FieldFile): the image, as stored in an ImageField or FileField
+        size (str): the size of the derivative, which is a key of IMAGE_DERIVATIVE_SIZES
+    
+    Returns:
+        str: the name of the derivative, or of the image itself, in the storage of the image
+    """
+    storage = image_file.storage
+    name = image_derivative_name(image_file.name, size)
+    if not storage.exists(name):
+        content = render_image_derivative(image_file, IMAGE_DERIVATIVE_SIZES[size])
+        if content is None:
+            return image_file.name
+        name = storage.save(name, content)
+    return name
+
+
+def deliver_media(storage, name):
+    """Returns the response that delivers a stored file with the backend in settings.MEDIA_DELIVERY_BACKEND, which is one of
+        "stream": the file is streamed by this process, which works with any storage
+        "presigned": redirect to a URL of the storage valid for settings.MEDIA_PRESIGNED_URL_EXPIRY seconds,
+            which needs a storage that signs URLs, such as S3Boto3Storage
+        "accel": empty response with an X-Accel-Redirect header to settings.MEDIA_ACCEL_REDIRECT_PREFIX followed by the name,
+            for a front proxy to serve the file from an internal location
+    Access to the file must be checked before calling this function.
+
+    Args:
+        storage (Storage): the storage of the file
+        name (str): the name of the file in the storage
+    
+    Returns:
+        HttpResponse: the response delivering the file
+    """
+    if settings.MEDIA_DELIVERY_BACKEND == "presigned":
+        return HttpResponseRedirect(storage.url(name, expire=settings.MEDIA_PRESIGNED_URL_EXPIRY))
+    if settings.MEDIA_DELIVERY_BACKEND == "accel":
+        response = HttpResponse(content_type=mimetypes.guess_type(name)[0] or "application/octet-stream")
+        response["X-Accel-Redirect"] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + quote(name)
+        return response
+    return FileResponse(storage.open(name))
+
+
+def image_file_response(request, image_file):
+    """Returns the response with the image, or with its derivative of the size in the size GET parameter if it is provided.
+    The response has an ETag derived from the name of the image, and a conditional request with a matching ETag
+    is answered with 304 without opening the file. Otherwise, the file is delivered by deliver_media. Responses are only cached privately, as the views check access to each image,
+    for a long time if the v GET parameter is the current version of the image, otherwise they must be revalidated.
+    Access to the image must be checked before calling this function.
+
+    Args:
+        request (HttpRequest): the request for the image
+        image_file (FieldFile): the image, as stored in an ImageField or FileField
+    
+    Returns:
+        HttpResponse: the image or its derivative, 304 if it is not modified, or the error if the size is not recognised
+    """
+    size = request.GET.get("size")
+    if size is not None and size not in IMAGE_DERIVATIVE_SIZES:
+        return HttpResponseBadRequest("size not recognised")
+
+    version = media_version(image_file.name)
+    etag = quote_etag(f"{version}-{size or 'original'}")
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = deliver_media(image_file.storage, image_file.name if size is None else get_image_derivative(image_file, size))
+    response["ETag"] = etag
+    if isinstance(response, HttpResponseRedirect):
+        # the redirect must not outlive the presigned URL
+        patch_cache_control(response, private=True, max_age=settings.MEDIA_PRESIGNED_URL_EXPIRY // 2)
+    elif request.GET.get("v") == version:
+        patch_cache_control(response, private=True, max_age=VERSIONED_MEDIA_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
@@ -0,0 +1,24 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from redis.exceptions import RedisError
+
+
+def group_send(group_name, event):
+    try:
+        async_to_sync(get_channel_layer().group_send)(group_name, event)
+    except (OSError, RedisError):
+        # events are best effort, clients still have the HTTP endpoints to catch up with
+        pass
+
+
+def group_send_on_commit(group_name, event):
+    """Sends the event to the channel layer group once the current transaction is committed,
+    so that the consumers receiving it read the committed state from the database.
+    The event is dropped if the channel layer cannot be reached.
+
+    Args:
+        group_name (str): the name of the channel layer group
+        event (dict): the event to send, whose "type" is the name of the consumer method handling it
+    """
+    transaction.on_commit(lambda: group_send(group_name, event))
@@ -0,0 +1,112 @@
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+
+from user_auth.models import Tag
+from user_log.models import UserLog
+
+
+# kinds of sets in the social graph, which are cached and invalidated separately
+FRIENDS = "friends"
+TAGS = "tags"
+
+
+def social_graph_version_key(kind, user_auth_id):
+    return f"social_graph:{kind}:version:{user_auth_id}"
+
+
+def social_graph_cache_key(kind, user_auth_id, version):
+    return f"social_graph:{kind}:{user_auth_id}:{version}"
+
+
+def social_graph_versions(kind, user_auth_ids):
+    """Returns the current cache versions of the sets of the kind of the users with the UserAuth ids, creating the missing ones."""
+    version_keys = {user_auth_id: social_graph_version_key(kind, user_auth_id) for user_auth_id in user_auth_ids}
+    versions = cache.get_many(list(version_keys.values()))
+    result = {}
+    for user_auth_id, version_key in version_keys.items():
+        version = versions.get(version_key)
+        if version is None:
+            version = str(uuid.uuid4())
+            if not cache.add(version_key, version, None):
+                version = cache.get(version_key)
+        result[user_auth_id] = version
+    return result
+
+
+class SocialGraph:
+    """Snapshot of the friends and tags of users, used by the permission helpers so that repeated checks are set lookups.
+    The friends of a user are the ids of the UserLog instances of their friends, and the tags of a user are the ids of their tags,
+    both as frozensets keyed by the id of the UserAuth instance of the user.
+    Each set is loaded from the database once per snapshot, and shared across requests through the cache for
+    settings.SOCIAL_GRAPH_CACHE_TIMEOUT seconds, if it is positive and use_cache is True.
+    Cached sets are keyed by a version of the set, which is replaced when friends or tags change, so that a set read from the database
+    before a change and cached after it is never used. Checks before writes should still use a snapshot without the cache,
+    as the version is only replaced once the change is committed.
+    """
+
+    def __init__(self, use_cache=True):
+        self.use_cache = use_cache
+        self._friend_ids = {}
+        self._tag_ids = {}
+
+    def _load(self, user_auth_ids, loaded, kind, load_from_db):
+        missing = set(user_auth_ids) - loaded.keys()
+        if not missing:
+            return
+        timeout = settings.SOCIAL_GRAPH_CACHE_TIMEOUT if self.use_cache else 0
+        if timeout > 0:
+            # the versions are read before the database, so that a change committed in between replaces them
+            versions = social_graph_versions(kind, missing)
+            cache_keys = {user_auth_id: social_graph_cache_key(kind, user_auth_id, version) for user_auth_id, version in versions.items()}
+            cached = cache.get_many(list(cache_keys.values()))
+            for user_auth_id in list(missing):
+                if cache_keys[user_auth_id] in cached:
+                    loaded[user_auth_id] = cached[cache_keys[user_auth_id]]
+                    missing.remove(user_auth_id)
+        if not missing:
+            return
+        from_db = {user_auth_id: set() for user_auth_id in missing}
+        for (user_auth_id, related_id) in load_from_db(missing):
+            from_db[user_auth_id].add(related_id)
+        from_db = {user_auth_id: frozenset(ids) for user_auth_id, ids in from_db.items()}
+        loaded.update(from_db)
+        if timeout > 0:
+            cache.set_many({cache_keys[user_auth_id]: ids for user_auth_id, ids in from_db.items()}, timeout)
+
+    def load_friend_ids(self, user_auth_ids):
+        """Loads the friends of all the users that are not in the snapshot yet, with at most one query."""
+        self._load(user_auth_ids, self._friend_ids, FRIENDS, lambda missing: UserLog.objects.filter(
+            friend_list__user_auth__in=missing
+        ).values_list("friend_list__user_auth", "id"))
+
+    def load_tag_ids(self, user_auth_ids):
+        """Loads the tags of all the users that are not in the snapshot yet, with at most one query."""
+        self._load(user_auth_ids, self._tag_ids, TAGS, lambda missing: Tag.objects.filter(
+            user_profiles__in=missing
+        ).values_list("user_profiles", "id"))
+
+    def friend_ids(self, user_auth_obj):
+        """Returns the frozenset of ids of the UserLog instances that are friends with the user."""
+        self.load_friend_ids([user_auth_obj.pk])
+        return self._friend_ids[user_auth_obj.pk]
+
+    def tag_ids(self, user_auth_obj):
+        """Returns the frozenset of ids of the tags of the user."""
+        self.load_tag_ids([user_auth_obj.pk])
+        return self._tag_ids[user_auth_obj.pk]
+
+
+def social_graph(request):
+    """Returns the social graph snapshot of the request, creating it on first use."""
+    if not hasattr(request, "_social_graph"):
+        request._social_graph = SocialGraph()
+    return request._social_graph
+
+
+def invalidate_social_graph(friend_user_auth_ids=(), tag_user_auth_ids=()):
+    """Replaces the cache versions of the friends and tags of the users with the UserAuth ids, so that their cached sets are not used anymore."""
+    cache.set_many({
+        **{social_graph_version_key(FRIENDS, user_auth_id): str(uuid.uuid4()) for user_auth_id in friend_user_auth_ids},
+        **{social_graph_version_key(TAGS, user_auth_id): str(uuid.uuid4()) for user_auth_id in tag_user_auth_ids},
+    }, None)
@@ -0,0 +1,82 @@
+import uuid
+from django.core.cache import cache
+from django.urls import reverse
+
+from user_auth.models import Tag, TagRequest
+from utils.media import versioned_media_url
+
+
+# version of the tag catalog shared by all processes through the cache, changed whenever a tag or tag request changes
+TAG_CATALOG_VERSION_KEY = "tag_catalog_version"
+
+# (version, tags sorted by lowercase name, set of lowercase names of tag requests) of the catalog in this process
+_tag_catalog = (None, [], set())
+
+
+def invalidate_tag_catalog():
+    """Makes every process reload the tag catalog on its next use."""
+    global _tag_catalog
+    cache.set(TAG_CATALOG_VERSION_KEY, str(uuid.uuid4()), None)
+    _tag_catalog = (None, [], set())
+
+
+def load_tag_catalog():
+    """Returns the tag catalog of this process, reloading it from the database if it is outdated.
+
+    Returns:
+        tuple(list(dict), set(str)): the tags sorted by lowercase name, each a dictionary with fields id, name, lower_name and icon,
+        and the set of lowercase names of the tag requests
+    """
+    global _tag_catalog
+    version = cache.get(TAG_CATALOG_VERSION_KEY)
+    if version is None:
+        version = str(uuid.uuid4())
+        if not cache.add(TAG_CATALOG_VERSION_KEY, version, None):
+            version = cache.get(TAG_CATALOG_VERSION_KEY)
+
+    catalog_version, tags, tag_request_names = _tag_catalog
+    if catalog_version != version:
+        tags = sorted(map(
+            lambda tag: {
+                "id": tag[0],
+                "name": tag[1],
+                "lower_name": tag[1].lower(),
+                "icon": versioned_media_url(reverse("user_profile:get_tag_icon", args=(tag[0],)), tag[2]),
+            },
+            Tag.objects.values_list("id", "name", "image")
+        ), key=lambda tag: (tag["lower_name"], tag["id"]))
+        tag_request_names = set(map(lambda name: name.lower(), TagRequest.objects.values_list("name", flat=True)))
+        _tag_catalog = (version, tags, tag_request_names)
+    return tags, tag_request_names
+
+
+def all_tags():
+    """Returns the name and icon URL of every tag, sorted by lowercase name."""
+    tags, _ = load_tag_catalog()
+    return list(map(lambda tag: {"name": tag["name"], "icon": tag["icon"]}, tags))
+
+
+def search_tag_catalog(search_param, excluded_tag_ids=()):
+    """Returns the name and icon URL of the tags whose names contain the search parameter case-insensitively,
+    sorted by lowercase name.
+
+    Args:
+        search_param (str): the search parameter
+        excluded_tag_ids (set(int)): ids of tags to leave out of the results
+    
+    Returns:
+        list(dict): the tags that match the search parameter, each with fields name and icon
+    """
+    search_param = search_param.lower()
+    tags, _ = load_tag_catalog()
+    return list(map(
+        lambda tag: {"name": tag["name"], "icon": tag["icon"]},
+        filter(lambda tag: search_param in tag["lower_name"] and tag["id"] not in excluded_tag_ids, tags)
+    ))
+
+
+def tag_name_taken(tag_name):
+    """Returns whether there is a tag or tag request with the same name, case-insensitively."""
+    tag_name = tag_name.lower()
+    tags, tag_request_names = load_tag_catalog()
+    return tag_name in tag_request_names or any(map(lambda tag: tag["lower_name"] == tag_name, tags))
@@ -0,0 +1,91 @@
+import mimetypes
+from functools import wraps
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import HttpResponseBadRequest
+
+
+BINARY_UPLOAD_CHUNK_SIZE = 64 * 1024
+BINARY_UPLOAD_FIELD = "binary" # key of binary uploads in request.FILES
+
+
+class SizeLimitedUploadHandler(FileUploadHandler):
+    """Upload handler that stops parsing a multipart request as soon as one of its files grows beyond
+    settings.UPLOAD_STREAM_MAX_SIZE, so that oversized files are rejected without being copied into memory or a temporary file.
+    It does not limit what is received: under ASGI the whole body has already been spooled to a temporary file by the
+    ASGI handler before the view runs, so the size of requests must be limited by the server in front of the app.
+    It must come before the handlers that store the file in settings.FILE_UPLOAD_HANDLERS.
+    As the oversized file and the rest of the body are then left out of request.POST and request.FILES,
+    the request is marked with upload_too_large, and views taking files must be decorated with reject_oversized_uploads.
+    """
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > settings.UPLOAD_STREAM_MAX_SIZE:
+            self.request.upload_too_large = True
+            raise StopUpload(connection_reset=True)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def reject_oversized_uploads(view):
+    """Decorator of views taking uploaded files, which responds with status 400 if one of the files is larger than
+    settings.UPLOAD_STREAM_MAX_SIZE, instead of calling the view with only the files before it.
+    """
+    @wraps(view)
+    def wrapped_view(request, *args, **kwargs):
+        request.POST # parses the body, see SizeLimitedUploadHandler
+        if getattr(request, "upload_too_large", False):
+            return HttpResponseBadRequest("file too large")
+        return view(request, *args, **kwargs)
+    return wrapped_view
+
+
+def is_binary_upload(request):
+    """Returns whether the request body is the raw content of a single file, sent with content type application/octet-stream."""
+    return request.content_type == "application/octet-stream"
+
+
+def upload_params(request):
+    """Returns the parameters of an upload request, which are in the query string for binary uploads
+    (as the body is the file itself) and in the body form data otherwise.
+    """
+    return request.GET if is_binary_upload(request) else request.POST
+
+
+def read_binary_upload(request, file_name):
+    """Reads the body of a binary upload into a temporary file, chunk by chunk, so that the file is never fully held in memory.
+    The content type of the file is guessed from the file name.
+    The file is also added to request.FILES under BINARY_UPLOAD_FIELD, so that it is closed together with the request.
+
+    Args:
+        request (HttpRequest): the binary upload request
+        file_name (str): the name of the uploaded file
+    
+    Returns:
+        UploadedFile: the uploaded file, or None if it is larger than settings.UPLOAD_STREAM_MAX_SIZE
+    """
+    try:
+        if int(request.META.get("CONTENT_LENGTH") or 0) > settings.UPLOAD_STREAM_MAX_SIZE:
+            return None
+    except ValueError:
+        return None
+
+    content_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    uploaded_file = TemporaryUploadedFile(file_name, content_type, 0, None)
+    request.FILES.appendlist(BINARY_UPLOAD_FIELD, uploaded_file)
+    size = 0
+    while True:
+        chunk = request.read(BINARY_UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > settings.UPLOAD_STREAM_MAX_SIZE:
+            uploaded_file.close()
+            return None
+        uploaded_file.write(chunk)
+    uploaded_file.seek(0)
+    uploaded_file.size = size
+    return uploaded_file
@@ -1,28 +1,33 @@
 from user_auth.models import UserAuth
+from utils.social_graph import SocialGraph
 
 
-def has_same_tag(request_profile, target_profile):
-    target_tag_list = target_profile.tagList.all()
-    for tag in request_profile.tagList.all():
-        if tag in target_tag_list:
-            return True
-    return False
+def has_same_tag(request_profile, target_profile, snapshot=None):
+    """Returns whether the two users have at least one tag in common.
+    The users may be given as UserAuth or UserProfile instances, which share the same primary key.
+    The tags are read from the snapshot, or from a new one if none is given.
+    """
+    snapshot = snapshot or SocialGraph()
+    return not snapshot.tag_ids(request_profile).isdisjoint(snapshot.tag_ids(target_profile))
 
 
-def can_view_profile(request_user_auth, target_username):
-    if not UserAuth.objects.filter(username=target_username).exists():
+def can_view_profile(request_user_auth, target_username, snapshot=None):
+    try:
+        target_auth = UserAuth.objects.select_related("user_log").get(username=target_username)
+    except UserAuth.DoesNotExist:
         return False
 
-    target_log = UserAuth.objects.get(username=target_username).user_log
+    snapshot = snapshot or SocialGraph()
+    target_log = target_auth.user_log
     if target_log.public_visible:
         return True
     if target_log.friend_visible:
-        if target_log.friend_list.filter(user_auth=request_user_auth).exists():
+        if target_log.id in snapshot.friend_ids(request_user_auth):
             if target_log.tag_visible:
-                return has_same_tag(request_user_auth.user_profile, target_log.user_profile)
+                return has_same_tag(request_user_auth, target_auth, snapshot)
             else:
                 return True
         else:
             return False
     else:
-        return has_same_tag(request_user_auth.user_profile, target_log.user_profile)
+        return has_same_tag(request_user_auth, target_auth, snapshot)